@@ -0,0 +1,275 @@
+"""
+Incremental reader of Xray's access log: near-real-time user activity and who is online.
+
+AccessLogTailer follows the log by byte offset. The offset is saved to a small state file after
+every flush, so a restart resumes where it stopped (lines after the last flush are read again,
+which is harmless: last_active only moves forward). Rotation is detected by inode (the old file
+is drained before switching to the new one) and truncation (logrotate copytruncate) by the file
+shrinking below the offset.
+
+Appended data is parsed a chunk at a time with one precompiled regex (finditer over the whole
+chunk, no per-line split/decode). Accepted connections go into an in-memory ActivityTable;
+last-seen times reach users.last_active in one batched UPDATE every FLUSH_INTERVAL seconds,
+never per line.
+
+Xray only logs accepted connections (no closes), so `connections` and `ips` are counted over the
+last ONLINE_WINDOW seconds, not live sockets.
+
+Runs inside the API process when XRAY_ACCESS_LOG names the access log (vless.sh enables it).
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from manage_vless import VPNManager
+from metrics import ACCESS_LOG_LINES, OPERATIONS
+
+log = logging.getLogger("vless.access_log")
+
+# Seconds between reads of the log
+POLL_INTERVAL = 1.0
+# Seconds between last_active flushes (and offset saves)
+FLUSH_INTERVAL = 15.0
+# A user counts as online for this many seconds after their last accepted connection
+ONLINE_WINDOW = 300
+# Bytes read per call; a poll loops until EOF
+READ_CHUNK = 1 << 20
+# A "line" without a newline longer than this is dropped instead of buffered
+MAX_LINE = 64 * 1024
+
+# 2024/05/01 10:00:00.123456 from 1.2.3.4:51234 accepted tcp:www.google.com:443 [vless-in >> direct] email: user_1
+# (older Xray: no "from ", source may carry a tcp:/udp: prefix, IPv6 sources are bracketed)
+LINE_RE = re.compile(
+    rb"^(\d{4}/\d\d/\d\d \d\d:\d\d:\d\d)\S* (?:from )?(?:(?:tcp|udp):)?(\[[^\]]+\]|[^\s:]+):\d+ accepted .*?email: (\S+)",
+    re.M)
+
+
+class _Activity:
+    __slots__ = ("last_seen", "ips", "connections")
+
+    def __init__(self):
+        self.last_seen = 0
+        self.ips: Dict[str, int] = {}  # Source IP -> last seen
+        self.connections: Dict[int, int] = {}  # Minute (epoch // 60) -> accepted connections
+
+
+class ActivityTable:
+    """Per-user last seen / source IPs / recent connections, fed by the tailer, read by the API."""
+
+    def __init__(self, window: int = ONLINE_WINDOW):
+        self.window = window
+        self._users: Dict[str, _Activity] = {}
+        self._dirty: Dict[str, int] = {}  # username -> last seen not yet written to the DB
+        self._lock = threading.Lock()
+
+    def record(self, hits: Iterable[Tuple[str, str, int]]):
+        """hits: (username, source ip, epoch) per accepted connection."""
+        with self._lock:
+            for username, ip, ts in hits:
+                activity = self._users.get(username)
+                if activity is None:
+                    activity = self._users[username] = _Activity()
+                if ts > activity.last_seen:
+                    activity.last_seen = ts
+                    self._dirty[username] = ts
+                if ts > activity.ips.get(ip, 0):
+                    activity.ips[ip] = ts
+                minute = ts // 60
+                activity.connections[minute] = activity.connections.get(minute, 0) + 1
+
+    def take_dirty(self) -> Dict[str, int]:
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            return dirty
+
+    def prune(self, now: Optional[int] = None):
+        """Forgets IPs, minutes and users older than the window (unflushed users are kept)."""
+        now = int(time.time()) if now is None else now
+        cutoff = now - self.window
+        with self._lock:
+            for username in list(self._users):
+                activity = self._users[username]
+                if activity.last_seen < cutoff and username not in self._dirty:
+                    del self._users[username]
+                    continue
+                activity.ips = {ip: ts for ip, ts in activity.ips.items() if ts >= cutoff}
+                activity.connections = {m: n for m, n in activity.connections.items() if m >= cutoff // 60}
+
+    def online(self, now: Optional[int] = None) -> List[Dict]:
+        """Users seen in the last `window` seconds, most recent first."""
+        now = int(time.time()) if now is None else now
+        cutoff = now - self.window
+        with self._lock:
+            rows = [{"username": username, "last_seen": a.last_seen,
+                     "ips": sum(1 for ts in a.ips.values() if ts >= cutoff),
+                     "connections": sum(n for m, n in a.connections.items() if m >= cutoff // 60)}
+                    for username, a in self._users.items() if a.last_seen >= cutoff]
+        rows.sort(key=lambda r: r["last_seen"], reverse=True)
+        return rows
+
+    def online_count(self, now: Optional[int] = None) -> int:
+        cutoff = (int(time.time()) if now is None else now) - self.window
+        with self._lock:
+            return sum(1 for a in self._users.values() if a.last_seen >= cutoff)
+
+
+class AccessLogTailer:
+    def __init__(self, manager: VPNManager, path: str, offset_file: Optional[str] = None,
+                 poll_interval: float = POLL_INTERVAL, flush_interval: float = FLUSH_INTERVAL):
+        self.manager = manager
+        self.path = path
+        self.offset_file = offset_file
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+        self.table = ActivityTable()
+        self._file = None
+        self._inode = None
+        self._offset = 0  # Bytes of the current file consumed (including the buffered partial line)
+        self._partial = b""
+        self._stamp = None  # Last parsed timestamp and its epoch (consecutive lines share seconds)
+        self._stamp_epoch = 0
+
+    # --- offsets ---
+
+    def _saved_offset(self) -> Tuple[Optional[int], int]:
+        if not self.offset_file:
+            return None, 0
+        try:
+            with open(self.offset_file) as f:
+                state = json.load(f)
+            return state.get("inode"), int(state.get("offset", 0))
+        except (OSError, ValueError):
+            return None, 0
+
+    def save_offset(self):
+        if not self.offset_file or self._file is None:
+            return
+        tmp_path = self.offset_file + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"inode": self._inode, "offset": self._offset - len(self._partial)}, f)
+        os.replace(tmp_path, self.offset_file)
+
+    def _open(self, rotated: bool = False) -> bool:
+        """
+        Opens the log. Resumes at the saved offset if it is the same file; a log we have never
+        seen is read from the start after a rotation, otherwise from the end (like tail -f).
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        st = os.fstat(f.fileno())
+        inode, offset = self._saved_offset()
+        if inode == st.st_ino and offset <= st.st_size:
+            start = offset
+        elif rotated or inode is not None:
+            start = 0  # Rotated since the offset was saved (or just now)
+        else:
+            start = st.st_size
+        f.seek(start)
+        self._file, self._inode, self._offset, self._partial = f, st.st_ino, start, b""
+        return True
+
+    # --- reading ---
+
+    def _epoch(self, stamp: bytes) -> int:
+        # Xray writes local time
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self._stamp_epoch = int(time.mktime(time.strptime(stamp.decode(), "%Y/%m/%d %H:%M:%S")))
+        return self._stamp_epoch
+
+    def _parse(self, data: bytes) -> int:
+        now = int(time.time())
+        hits = [(email.decode(errors="replace"), ip.strip(b"[]").decode(errors="replace"), min(self._epoch(stamp), now))
+                for stamp, ip, email in (m.groups() for m in LINE_RE.finditer(data))]
+        self.table.record(hits)
+        ACCESS_LOG_LINES.inc("accepted", amount=len(hits))
+        ACCESS_LOG_LINES.inc("other", amount=data.count(b"\n") - len(hits))
+        return len(hits)
+
+    def _drain(self) -> int:
+        parsed = 0
+        while True:
+            chunk = self._file.read(READ_CHUNK)
+            if not chunk:
+                return parsed
+            self._offset += len(chunk)
+            data = self._partial + chunk
+            end = data.rfind(b"\n") + 1
+            self._partial = data[end:]
+            if len(self._partial) > MAX_LINE:
+                self._partial = b""
+            if end:
+                parsed += self._parse(data[:end])
+
+    @OPERATIONS.timed("access_log_poll")
+    def poll(self) -> int:
+        """Reads everything appended since the last call. Returns the number of accepted connections parsed."""
+        if self._file is None and not self._open():
+            return 0
+        parsed = self._drain()
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return parsed  # Rotated away, new file not created yet: keep the old one
+        if st.st_ino != self._inode:
+            # Rotated: finish the old file, continue with the new one from its start
+            parsed += self._drain()
+            self._file.close()
+            self._file = None
+            if self._open(rotated=True):
+                parsed += self._drain()
+        elif st.st_size < self._offset - len(self._partial):
+            # Truncated in place (copytruncate)
+            self._file.seek(0)
+            self._offset, self._partial = 0, b""
+            parsed += self._drain()
+        return parsed
+
+    @OPERATIONS.timed("access_log_flush")
+    def flush(self) -> int:
+        """Writes new last-seen times to users.last_active in one transaction, then saves the offset."""
+        dirty = self.table.take_dirty()
+        updated = self.manager.touch_users(dirty) if dirty else 0
+        self.save_offset()
+        self.table.prune()
+        return updated
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def run(self):
+        """Polls every `poll_interval` and flushes every `flush_interval` seconds until cancelled."""
+        log.info(f"Tailing {self.path}")
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    await asyncio.to_thread(self.poll)
+                    if time.monotonic() - last_flush >= self.flush_interval:
+                        last_flush = time.monotonic()
+                        await asyncio.to_thread(self.flush)
+                except Exception as e:
+                    log.exception(f"Access log poll failed: {e}")
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            try:
+                self.flush()
+            finally:
+                self.close()
+
+
+def access_log_from_settings(manager: VPNManager) -> Optional[AccessLogTailer]:
+    """Tailer for XRAY_ACCESS_LOG (offset kept in ACCESS_LOG_OFFSET_FILE), or None when it is empty."""
+    settings = manager.settings
+    if not settings.xray_access_log:
+        return None
+    return AccessLogTailer(manager, settings.xray_access_log, offset_file=settings.access_log_offset_file)
@@ -1,80 +1,369 @@
-from fastapi import FastAPI, Header, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, Body, Header, HTTPException, Depends, Query, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List, Dict
 import os
-from manage_vless import VPNManager
+import json
+import asyncio
+import time
+from manage_vless import VPNManager, USER_FIELDS, LIVE_UPDATE_MAX_CHANGES
+from settings import Settings
+from links import qr_code
+from reaper import reaper_from_settings
+from mutation_queue import MutationQueue
+from auth import KeyStore
+from fleet import fleet_from_settings
+from pool import pool_from_settings
+from access_log import access_log_from_settings
+import metrics
 
-app = FastAPI()
-manager = VPNManager()
 
-API_KEY_FILE = "/opt/vless/api_key.txt"
+class Services:
+    """Everything one API instance owns, built from its Settings when the app starts."""
 
-def get_api_key(x_api_key: str = Header(...)):
-    if not os.path.exists(API_KEY_FILE):
+    def __init__(self, settings: Settings, manager: Optional[VPNManager] = None):
+        self.settings = settings
+        self.manager = manager or VPNManager(settings)
+        # All user mutations go through this single writer (see mutation_queue.py)
+        self.mutations = MutationQueue(self.manager)
+        # Pre-created users handed out by POST /user (see pool.py)
+        self.pool = pool_from_settings(self.manager)
+        # In-memory key set, reloaded when api_key.txt changes (see auth.py)
+        self.keystore = KeyStore(settings.api_key_file)
+        # Set at startup when FLEET_NODES is configured (see fleet.py)
+        self.fleet = None
+        # Near-real-time activity from Xray's access log (see access_log.py); None when XRAY_ACCESS_LOG is empty
+        self.access_log = access_log_from_settings(self.manager)
+        self.tasks = []
+
+    async def start(self):
+        self.manager.init_db()
+        self.mutations.start()
+        self.pool.kick(self.mutations)
+        loop = asyncio.get_running_loop()
+
+        def queued_apply(creates, deletes, live_limit=None):
+            # Fleet fan-out and the reaper run in threads; local changes still go through the single writer
+            return asyncio.run_coroutine_threadsafe(
+                self.mutations.call(self.manager.apply_batch, creates=creates, deletes=deletes,
+                                    live_limit=live_limit), loop).result()
+
+        self.fleet = fleet_from_settings(self.manager, local_apply=queued_apply)
+        if self.fleet is not None:
+            self.tasks.append(asyncio.create_task(asyncio.to_thread(self.fleet.refresh_placement)))
+        # Stats sampler / idle reaper (unless REAPER_IN_API=false runs vless-reaper.service instead).
+        # Its deletions go through the single writer like every other change
+        if self.settings.reaper_in_api:
+            reaper = reaper_from_settings(self.manager, delete=lambda usernames: queued_apply([], usernames))
+            self.tasks.append(asyncio.create_task(reaper.run()))
+        if self.access_log is not None:
+            self.tasks.append(asyncio.create_task(self.access_log.run()))
+            metrics.ONLINE_USERS.callback = lambda: {(): self.access_log.table.online_count()}
+        metrics.USERS.callback = lambda: {(state,): n for state, n in self.manager.user_counts().items()}
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        # Let them finish (the access log tailer flushes last_active on the way out)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.mutations.stop()
+        self.manager.flush_config()
+
+
+def create_app(settings: Optional[Settings] = None, manager: Optional[VPNManager] = None) -> FastAPI:
+    """
+    Builds one API instance. Nothing is opened until startup: settings default to Settings.from_env()
+    (/opt/vless/.env, or VLESS_ENV_FILE) and the VPNManager is created then unless one is passed in.
+    """
+    app = FastAPI()
+    app.include_router(router)
+    app.middleware("http")(instrument)
+
+    @app.on_event("startup")
+    async def startup():
+        app.state.services = Services(settings or (manager.settings if manager else Settings.from_env()), manager)
+        await app.state.services.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await app.state.services.stop()
+
+    return app
+
+
+def get_services(request: Request) -> Services:
+    return request.app.state.services
+
+
+def get_manager(request: Request) -> VPNManager:
+    return request.app.state.services.manager
+
+
+async def instrument(request: Request, call_next):
+    settings = request.app.state.services.settings
+    profiler = None
+    # Opt-in profiling: requests sent with an "X-Profile: 1" header are sampled and the stacks written to PROFILE_DIR
+    if settings.profile_requests and request.headers.get("x-profile"):
+        profiler = metrics.SamplingProfiler()
+        profiler.start()
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.HTTP_REQUESTS.observe(time.perf_counter() - start, request.method,
+                                  route.path if route is not None else "unmatched", response.status_code)
+    if profiler is not None:
+        profiler.stop()
+        os.makedirs(settings.profile_dir, exist_ok=True)
+        path = os.path.join(settings.profile_dir, f"{int(time.time() * 1000)}-{request.method}-{request.url.path.strip('/').replace('/', '_')}.folded")
+        with open(path, 'w') as f:
+            f.write(profiler.folded())
+        response.headers["X-Profile-File"] = path
+    return response
+
+
+router = APIRouter()
+
+async def get_api_key(request: Request, x_api_key: str = Header(...)):
+    keystore = request.app.state.services.keystore
+    entry = keystore.lookup(x_api_key)
+    if keystore.missing:
         raise HTTPException(status_code=500, detail="Server not configured correctly (missing api key file)")
-    
-    with open(API_KEY_FILE, 'r') as f:
-        valid_keys = [k.strip() for k in f.readlines() if k.strip()]
-    
-    if x_api_key not in valid_keys:
+
+    if entry is None:
         raise HTTPException(status_code=403, detail="Invalid API Key")
+    if not entry.allow():
+        raise HTTPException(status_code=429, detail=f"Rate limit exceeded for key '{entry.name}'")
     return x_api_key
 
 class CreateUserRequest(BaseModel):
     username: Optional[str] = None
     persistent: bool = False
 
-@app.post("/user")
-def create_user(req: CreateUserRequest, api_key: str = Depends(get_api_key)):
-    return manager.create_user(req.username, req.persistent)
+@router.post("/user")
+async def create_user(req: CreateUserRequest, api_key: str = Depends(get_api_key),
+                      svc: Services = Depends(get_services)):
+    res = await svc.mutations.create(req.username, req.persistent)
+    svc.pool.kick(svc.mutations)
+    return res
+
+@router.delete("/user/{username}")
+async def delete_user(username: str, api_key: str = Depends(get_api_key), svc: Services = Depends(get_services)):
+    return await svc.mutations.delete(username)
+
+class BatchRequest(BaseModel):
+    creates: List[CreateUserRequest] = []
+    deletes: List[str] = []
+
+@router.post("/users/batch")
+async def batch_users(req: BatchRequest, api_key: str = Depends(get_api_key), svc: Services = Depends(get_services)):
+    """
+    Applies many creates/deletes at once (deletes first).
+    Uses one DB transaction and one Xray config update for the whole batch
+    (a config write + Xray restart above LIVE_UPDATE_MAX_CHANGES client changes).
+    """
+    creates = [{"username": c.username, "persistent": c.persistent} for c in req.creates]
+    res = await svc.mutations.call(svc.manager.apply_batch, creates=creates, deletes=req.deletes,
+                                   live_limit=LIVE_UPDATE_MAX_CHANGES)
+    svc.pool.kick(svc.mutations)
+    return res
+
+@router.get("/user/{username}/link")
+def user_link(username: str, qr: bool = False, api_key: str = Depends(get_api_key),
+              manager: VPNManager = Depends(get_manager)):
+    """Returns the user's link; with ?qr=true also an SVG QR code (needs qrencode)."""
+    res = manager.get_user_link(username)
+    if res is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    if qr:
+        res["qr_svg"] = qr_code(res["link"])
+    return res
+
+@router.get("/users/links")
+def export_links(api_key: str = Depends(get_api_key), manager: VPNManager = Depends(get_manager)):
+    """Links for all users (bulk export)."""
+    return manager.export_links()
+
+@router.get("/users")
+def list_users(cursor: Optional[int] = None, limit: Optional[int] = Query(None, ge=1, le=10000),
+               persistent: Optional[bool] = None, active_since: Optional[int] = None,
+               idle_for: Optional[int] = None, min_traffic: Optional[int] = None,
+               inbound: Optional[str] = None, fields: Optional[str] = None, format: str = "json",
+               api_key: str = Depends(get_api_key), manager: VPNManager = Depends(get_manager)):
+    """
+    Lists users.
+    Filters: persistent, active_since (epoch), idle_for (seconds), min_traffic (bytes up+down), inbound (tag).
+    fields: comma-separated columns to return.
+    Pagination: pass limit to get {"users": [...], "next_cursor": ...}; send next_cursor back as cursor.
+    format=ndjson streams one JSON object per line straight from the DB cursor.
+    """
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    unknown = [f for f in field_list or [] if f not in USER_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    query = dict(cursor=cursor, limit=limit, persistent=persistent, active_since=active_since,
+                 idle_for=idle_for, min_traffic=min_traffic, inbound=inbound, fields=field_list)
+
+    if format == "ndjson":
+        rows = manager.iter_users(**query)
+        return StreamingResponse((json.dumps(row) + "\n" for row in rows), media_type="application/x-ndjson")
+    return manager.get_users(**query)
+
+def get_fleet(svc: Services = Depends(get_services)):
+    if svc.fleet is None:
+        raise HTTPException(status_code=404, detail="Fleet mode is not enabled (set FLEET_NODES)")
+    return svc.fleet
+
+@router.post("/fleet/users")
+async def fleet_create_users(req: BatchRequest, api_key: str = Depends(get_api_key), fleet=Depends(get_fleet)):
+    """
+    Batch across the fleet (deletes first). Each created user is placed on a node by FLEET_SCHEDULER
+    (or on the node that already has it); results carry the node and that node's link.
+    """
+    deleted = {"deleted": [], "not_found": [], "errors": []}
+    if req.deletes:
+        deleted = await asyncio.to_thread(fleet.delete_users, req.deletes)
+    creates = [{"username": c.username, "persistent": c.persistent} for c in req.creates]
+    created = await asyncio.to_thread(fleet.create_users, creates)
+    return {"created": created, **deleted}
+
+@router.post("/fleet/user")
+async def fleet_create_user(req: CreateUserRequest, api_key: str = Depends(get_api_key), fleet=Depends(get_fleet)):
+    created = await asyncio.to_thread(fleet.create_users, [{"username": req.username, "persistent": req.persistent}])
+    return created[0]
 
-@app.delete("/user/{username}")
-def delete_user(username: str, api_key: str = Depends(get_api_key)):
-    return manager.delete_user(username)
+@router.delete("/fleet/user/{username}")
+async def fleet_delete_user(username: str, api_key: str = Depends(get_api_key), fleet=Depends(get_fleet)):
+    res = await asyncio.to_thread(fleet.delete_users, [username])
+    if not res["deleted"]:
+        return {"error": "User not found", "errors": res["errors"]}
+    return res["deleted"][0] if len(res["deleted"]) == 1 else {"deleted": res["deleted"]}
 
-@app.get("/users")
-def list_users(api_key: str = Depends(get_api_key)):
-    return manager.get_users()
+@router.get("/fleet/nodes")
+async def fleet_nodes(api_key: str = Depends(get_api_key), fleet=Depends(get_fleet)):
+    return await asyncio.to_thread(fleet.nodes)
 
-@app.delete("/users/delete_all")
-def delete_all_users(force: bool = False, api_key: str = Depends(get_api_key)):
+@router.delete("/users/delete_all")
+async def delete_all_users(force: bool = False, api_key: str = Depends(get_api_key),
+                           svc: Services = Depends(get_services)):
     """
-    Deletes users. 
+    Deletes users.
     By default (force=False), deletes only transient users.
     If force=True, deletes ALL users including persistent/whitelisted.
     """
-    return manager.delete_all_users(force=force)
+    return await svc.mutations.call(svc.manager.delete_all_users, force=force)
 
-@app.get("/stats")
-def server_stats(api_key: str = Depends(get_api_key)):
-    return manager.get_stats()
+@router.post("/users/reconcile")
+async def reconcile(dry_run: bool = False, restart: bool = False, api_key: str = Depends(get_api_key),
+                    svc: Services = Depends(get_services)):
+    """
+    Brings config.json / Xray and whitelist.txt in line with the users table in one batched update.
+    dry_run=true only reports the differences; restart=true also restarts Xray afterwards.
+    """
+    return await svc.mutations.call(svc.manager.reconcile, dry_run=dry_run, restart=restart)
+
+@router.get("/users/snapshot")
+def export_snapshot(api_key: str = Depends(get_api_key), manager: VPNManager = Depends(get_manager)):
+    """All users (names, UUIDs, flags, traffic, inbound) in a compact form for POST /users/snapshot elsewhere."""
+    return manager.export_snapshot()
+
+@router.post("/users/snapshot")
+async def import_snapshot(snapshot: Dict = Body(...), replace: bool = False, api_key: str = Depends(get_api_key),
+                          svc: Services = Depends(get_services)):
+    """
+    Loads a snapshot from GET /users/snapshot: one DB transaction and one config update for all users.
+    replace=true deletes users that are not in the snapshot.
+    """
+    try:
+        res = await svc.mutations.call(svc.manager.import_snapshot, snapshot, replace=replace)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    svc.pool.kick(svc.mutations)
+    return res
+
+@router.get("/stats")
+def server_stats(api_key: str = Depends(get_api_key), svc: Services = Depends(get_services)):
+    stats = svc.manager.get_stats()
+    if svc.access_log is not None:
+        stats["online_users"] = svc.access_log.table.online_count()
+    return stats
+
+@router.get("/users/online")
+def online_users(api_key: str = Depends(get_api_key), svc: Services = Depends(get_services)):
+    """
+    Users with an accepted connection in the access log in the last ONLINE_WINDOW seconds,
+    with the number of source IPs and connections seen in that window.
+    """
+    if svc.access_log is None:
+        raise HTTPException(status_code=404, detail="Access log tailing is not enabled (set XRAY_ACCESS_LOG)")
+    return svc.access_log.table.online()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(request: Request, x_api_key: Optional[str] = Header(None)):
+    """Prometheus text format: operation/phase/request latency histograms, restart and lock counters, user gauges."""
+    # METRICS_PUBLIC: no API key needed (for scrapers that cannot send X-API-KEY)
+    if not request.app.state.services.settings.metrics_public:
+        await get_api_key(request, x_api_key or "")
+    return await asyncio.to_thread(metrics.render)
+
+@router.get("/stats/traffic/top")
+def traffic_top(window: int = Query(3600, ge=60), limit: int = Query(20, ge=1, le=1000),
+                api_key: str = Depends(get_api_key), manager: VPNManager = Depends(get_manager)):
+    """Top users by bytes (up + down) over the last `window` seconds."""
+    return manager.traffic_top(window=window, limit=limit)
+
+@router.get("/stats/traffic/server")
+def traffic_server(window: int = Query(3600, ge=60), resolution: str = "1m",
+                   since: Optional[int] = None, until: Optional[int] = None,
+                   api_key: str = Depends(get_api_key), manager: VPNManager = Depends(get_manager)):
+    """Server-wide totals over `window` plus the per-bucket series for since/until."""
+    try:
+        series = manager.traffic_series(None, resolution=resolution, since=since, until=until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {**manager.traffic_summary(window=window), "series": series}
+
+@router.get("/stats/traffic/user/{username}")
+def traffic_user(username: str, resolution: str = "1m", since: Optional[int] = None, until: Optional[int] = None,
+                 api_key: str = Depends(get_api_key), manager: VPNManager = Depends(get_manager)):
+    """Per-bucket traffic of one user ({"t": bucket start epoch, "up", "down"}); empty buckets are omitted."""
+    try:
+        series = manager.traffic_series(username, resolution=resolution, since=since, until=until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"username": username, "resolution": resolution, "series": series}
 
 class UpdateTokenRequest(BaseModel):
     token: Optional[str] = None
 
-@app.post("/token/update")
-def update_token(req: UpdateTokenRequest, api_key: str = Depends(get_api_key)):
+@router.post("/token/update")
+def update_token(req: UpdateTokenRequest, api_key: str = Depends(get_api_key), svc: Services = Depends(get_services)):
     """
-    Updates the API Token.
+    Updates the API Token used for this request.
     If 'token' is provided, sets it.
     If not, generates a new random one.
-    Returns the new token.
+    Returns the new token. Other keys in api_key.txt (and this key's name / rate limit) are kept.
     """
     import secrets
     new_token = req.token
     if not new_token:
         new_token = secrets.token_hex(16)
-    
+    if len(new_token.split()) != 1 or new_token != new_token.strip():
+        raise HTTPException(status_code=400, detail="Token must not contain whitespace")
+
     # Save to file
     try:
-        with open(API_KEY_FILE, 'w') as f:
-            f.write(new_token)
-            
+        svc.keystore.replace(api_key, new_token)
+
         # Also try to update .env if possible for consistency?
         # Python might not have permission to edit .env easily in a robust way without messy parsing.
         # Minimal viable: update the key file which is the source of truth for auth.
-        
+
         return {"status": "updated", "new_token": new_token}
+    except KeyError:
+        raise HTTPException(status_code=409, detail="Key was removed from the key file meanwhile")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+# `uvicorn api_server:app`: settings are read from the environment (VLESS_ENV_FILE) at startup
+app = create_app()
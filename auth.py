@@ -0,0 +1,131 @@
+"""
+API key verification for api_server.py.
+
+Keys from api_key.txt are kept in memory as SHA-256 digests and the file is only re-read when its
+mtime changes (checked at most once per CHECK_INTERVAL) or when reload() is called after
+/token/update writes it. A presented key is hashed and compared with hmac.compare_digest.
+
+api_key.txt format, one key per line:
+    <key> [<name> [<requests_per_minute>]]
+A bare key (what vless.sh and update_token.sh write) has no rate limit. Shell clients use the
+first key; update_token.sh replaces that one, /token/update the caller's.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+CHECK_INTERVAL = 1.0
+
+
+class KeyEntry:
+    def __init__(self, name: str, digest: bytes, rate_per_min: Optional[int]):
+        self.name = name
+        self.digest = digest
+        self.rate_per_min = rate_per_min
+        # Token bucket
+        self.tokens = float(rate_per_min or 0)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if not self.rate_per_min:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate_per_min, self.tokens + (now - self.updated) * self.rate_per_min / 60.0)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def _digest(key: str) -> bytes:
+    return hashlib.sha256(key.encode("utf-8")).digest()
+
+
+class KeyStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.missing = True
+        self._keys: Dict[bytes, KeyEntry] = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def reload(self):
+        """Re-reads the key file now. Rate-limit state of keys that still exist is kept."""
+        with self._lock:
+            self._load()
+
+    def replace(self, old: str, new: str):
+        """
+        Swaps key `old` for `new` in the key file, keeping its name / rate limit and every other line,
+        then reloads. Raises KeyError if `old` is not in the file.
+        """
+        with self._lock:
+            with open(self.path, 'r') as f:
+                lines = f.read().splitlines()
+            for i, line in enumerate(lines):
+                parts = line.split()
+                if parts and hmac.compare_digest(_digest(parts[0]), _digest(old)):
+                    lines[i] = " ".join([new] + parts[1:])
+                    break
+            else:
+                raise KeyError("key not found")
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.path)
+            self._load()
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self.missing, self._keys, self._mtime = True, {}, None
+            return
+        keys = {}
+        with open(self.path, 'r') as f:
+            for n, line in enumerate(f, start=1):
+                parts = line.split()
+                if not parts:
+                    continue
+                digest = _digest(parts[0])
+                name = parts[1] if len(parts) > 1 else f"key{n}"
+                try:
+                    rate = int(parts[2]) if len(parts) > 2 else None
+                except ValueError:
+                    rate = None
+                old = self._keys.get(digest)
+                if old is not None and old.name == name and old.rate_per_min == rate:
+                    keys[digest] = old
+                else:
+                    keys[digest] = KeyEntry(name, digest, rate)
+        self.missing, self._keys, self._mtime = False, keys, mtime
+        self._checked_at = time.monotonic()
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime or (mtime is None) != self.missing:
+            self._load()
+
+    def lookup(self, presented: str) -> Optional[KeyEntry]:
+        """The matching key entry, or None."""
+        digest = _digest(presented)
+        with self._lock:
+            self._maybe_reload()
+            entry = self._keys.get(digest)
+        if entry is None or not hmac.compare_digest(entry.digest, digest):
+            return None
+        return entry
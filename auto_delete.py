@@ -1,46 +1,35 @@
 import datetime
+import time
 from manage_vless import VPNManager
+from reaper import api_delete_from_settings
+from settings import Settings
 import logging
-import os
-from dotenv import load_dotenv
-
-logging.basicConfig(filename='/var/log/vless_autodel.log', level=logging.INFO, 
-                    format='%(asctime)s %(message)s')
-
-# Load .env
-load_dotenv("/opt/vless/.env")
 
 def auto_delete_idle_users():
-    manager = VPNManager()
-    
+    # Settings from .env (VLESS_ENV_FILE selects another instance)
+    settings = Settings.from_env()
+    manager = VPNManager(settings)
+
     # 1. Update Traffic Stats first
-    manager.update_stats_from_xray() 
-    
-    # Get timeout from env (default 3)
-    try:
-        timeout_hours = int(os.getenv("IDLE_TIMEOUT_HOURS", 3))
-    except:
-        timeout_hours = 3
+    manager.update_stats_from_xray()
+
+    timeout_hours = settings.idle_timeout_hours
 
     # 2. Check Logic
     users = manager.get_users()
-    cutoff_time = datetime.datetime.now() - datetime.timedelta(hours=timeout_hours)
+    # last_active is stored as epoch seconds
+    cutoff_time = int(time.time() - timeout_hours * 3600)
     
-    deleted_count = 0
+    idle = []
     
     for user in users:
         # DB returns row objects or dicts
         username = user['username']
         is_persistent = user['is_persistent']
-        last_active_str = user['last_active']
+        last_active = user['last_active']
         
-        # Parse timestamp
-        # Depending on sqlite storage, might need parsing. 
-        # Assuming ISO format storage by default python behavior if str
-        try:
-            last_active = datetime.datetime.fromisoformat(str(last_active_str))
-        except:
-            last_active = datetime.datetime.now() # Fail safe
+        if last_active is None:
+            last_active = int(time.time()) # Fail safe
             
         if is_persistent:
             continue
@@ -48,12 +37,21 @@ def auto_delete_idle_users():
         if last_active < cutoff_time:
             # Check traffic diff - if logic requires confirming "idle" via traffic
             # For now, assuming last_active is updated by the update_stats_from_xray() logic when traffic flows
-            logging.info(f"User {username} idle since {last_active}. Deleting.")
-            manager.delete_user(username)
-            deleted_count += 1
+            logging.info(f"User {username} idle since {datetime.datetime.fromtimestamp(last_active)}. Deleting.")
+            idle.append(username)
             
-    if deleted_count > 0:
-        logging.info(f"Cleaned up {deleted_count} idle users.")
+    if idle:
+        # Through the API, which owns config.json (see reaper.py)
+        res = api_delete_from_settings(settings)(idle)
+        logging.info(f"Cleaned up {len(res['deleted'])} idle users.")
+
+    # 3. Fold old server_stats events into daily counts
+    pruned = manager.prune_server_stats(settings.stats_retention_days)
+    if pruned > 0:
+        logging.info(f"Rolled up {pruned} old server_stats events.")
+    manager.prune_traffic()
 
 if __name__ == "__main__":
+    logging.basicConfig(filename='/var/log/vless_autodel.log', level=logging.INFO,
+                        format='%(asctime)s %(message)s')
     auto_delete_idle_users()
@@ -0,0 +1,124 @@
+"""
+SQLite throughput under concurrent load: pooled WAL connections vs. the old connect-per-call pattern.
+
+Runs create/delete/list against VPNManager with Xray and link generation stubbed out, so only
+the database layer is measured. Each mode gets its own temp DB.
+
+Usage: python3 benchmarks/bench_db.py [--threads 8] [--ops 300] [--seed-users 1000]
+Prints one JSON object per mode.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import manage_vless as mv  # noqa: E402
+from settings import Settings  # noqa: E402
+
+
+class BenchManager(mv.VPNManager):
+    """VPNManager with the Xray side disabled (no config writes, no restarts, no IP lookup)."""
+
+    def _commit_config(self, adds=(), removes=(), live_limit=None):
+        pass
+
+    def _link_contexts(self, config):
+        return {None: {"mode": "reality", "address": "127.0.0.1", "port": 443, "pbk": "", "sid": ""}}
+
+
+class LegacyManager(BenchManager):
+    """Pre-pooling behaviour: a fresh default (rollback journal) connection for every call."""
+
+    def init_db(self):
+        conn = sqlite3.connect(self.settings.db_path)
+        self._migrate(conn)
+        conn.close()
+
+    def _db(self):
+        return sqlite3.connect(self.settings.db_path)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.settings.db_path)
+        try:
+            yield conn.cursor()
+            conn.commit()
+        finally:
+            conn.close()
+
+
+MODES = {"legacy": LegacyManager, "pooled": BenchManager}
+
+
+def run(mode, workdir, threads, ops, seed_users):
+    manager = MODES[mode](Settings(db_path=os.path.join(workdir, "vless.db"),
+                                   whitelist_path=os.path.join(workdir, "whitelist.txt"),
+                                   xray_config_path=os.path.join(workdir, "config.json")))
+    manager.init_db()
+    manager.apply_batch(creates=[{"username": f"seed_{i}"} for i in range(seed_users)])
+
+    counts = {"create": 0, "delete": 0, "list": 0}
+    errors = []
+    lock = threading.Lock()
+
+    def worker(tid):
+        local = {"create": 0, "delete": 0, "list": 0}
+        for i in range(ops):
+            name = f"t{tid}_{i}"
+            try:
+                manager.create_user(name)
+                local["create"] += 1
+                if i % 10 == 0:
+                    manager.get_users()
+                    local["list"] += 1
+                manager.delete_user(name)
+                local["delete"] += 1
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors.append(str(e))
+        with lock:
+            for k, v in local.items():
+                counts[k] += v
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    manager.close_db()
+
+    total = sum(counts.values())
+    return {
+        "mode": mode,
+        "threads": threads,
+        "seed_users": seed_users,
+        "elapsed_s": round(elapsed, 3),
+        "ops": counts,
+        "ops_per_s": round(total / elapsed, 1),
+        "errors": len(errors),
+        "sample_error": errors[0] if errors else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=300, help="create+delete pairs per thread")
+    parser.add_argument("--seed-users", type=int, default=1000)
+    args = parser.parse_args()
+
+    for mode in MODES:
+        with tempfile.TemporaryDirectory() as workdir:
+            print(json.dumps(run(mode, workdir, args.threads, args.ops, args.seed_users)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+User-management lifecycle benchmark: VPNManager and the FastAPI app against throwaway state.
+
+Every run uses its own Settings (temp DB, config.json, link dir) and stub `systemctl` and `xray`
+binaries on PATH, so nothing on the host is touched. Xray itself is either
+    fake - fake_xray.FakeXray over gRPC (live updates + QueryStats; needs grpcio), or
+    stub - no gRPC: changes go through config write + (stub) restart, stats through the stub CLI.
+
+Scenarios per user count: seed (one bulk batch), create, delete, list (full and paged), stats,
+stats_ingest, access_log (parse + flush of an Xray access log chunk), api (concurrent POST/DELETE/GET through an in-process ASGI client; needs httpx)
+and purge (delete_transient_users). Each size runs in its own subprocess so peak RSS is per size.
+
+Usage: python3 benchmarks/bench_lifecycle.py [--users 1000 10000 100000] [--xray fake|stub]
+                                             [--ops 200] [--concurrency 32] [--out results.json]
+Prints (or writes) one JSON document: {"meta": {...}, "results": [{"users", "scenario", "ops",
+"elapsed_s", "ops_per_s", "p50_ms", "p99_ms", "peak_rss_mb"}, ...]}.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sqlite3
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import manage_vless as mv  # noqa: E402
+from settings import Settings  # noqa: E402
+from xray_api import XrayAPI, grpc  # noqa: E402
+
+STUB_SYSTEMCTL = "#!/bin/sh\nexit 0\n"
+# `xray api statsquery ...`: prints the counters prepared by the benchmark
+STUB_XRAY = "#!/bin/sh\ncat \"$BENCH_XRAY_STATS\" 2>/dev/null || echo '{}'\n"
+
+
+class CLIOnlyXrayAPI(XrayAPI):
+    """Behaves as if grpcio were missing (stub mode)."""
+
+    def available(self):
+        return False
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def summarize(users, scenario, latencies, elapsed=None):
+    """One result row from per-op latencies (seconds)."""
+    latencies = sorted(latencies)
+    n = len(latencies)
+    elapsed = sum(latencies) if elapsed is None else elapsed
+    pct = lambda p: round(latencies[min(n - 1, int(p * n))] * 1000, 3) if n else None
+    return {
+        "users": users,
+        "scenario": scenario,
+        "ops": n,
+        "elapsed_s": round(elapsed, 4),
+        "ops_per_s": round(n / elapsed, 1) if elapsed else None,
+        "p50_ms": pct(0.50),
+        "p99_ms": pct(0.99),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def setup(workdir, xray_mode):
+    """Temp paths, stub binaries and a manager wired to them. Returns (manager, fake or None)."""
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    for name, body in (("systemctl", STUB_SYSTEMCTL), ("xray", STUB_XRAY)):
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write(body)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+    os.environ["BENCH_XRAY_STATS"] = os.path.join(workdir, "stats.json")
+
+    linkdir = os.path.join(workdir, "links")
+    os.makedirs(linkdir)
+    with open(os.path.join(linkdir, "server_ip.txt"), "w") as f:
+        f.write("127.0.0.1")  # No ipify lookup
+    fake = None
+    if xray_mode == "fake":
+        from fake_xray import FakeXray
+        fake = FakeXray()
+        api_addr = f"127.0.0.1:{fake.start()}"
+    else:
+        api_addr = Settings.xray_api_addr
+    settings = Settings(db_path=os.path.join(workdir, "vless.db"),
+                        whitelist_path=os.path.join(workdir, "whitelist.txt"),
+                        xray_config_path=os.path.join(workdir, "config.json"),
+                        api_key_file=os.path.join(workdir, "api_key.txt"),
+                        xray_bin=os.path.join(bindir, "xray"), vless_dir=linkdir, xray_api_addr=api_addr,
+                        # The API scenario starts Services: no tailing of the host's access log (or writing
+                        # its offset), and no background reaper resetting traffic counters mid-run
+                        xray_access_log="", access_log_offset_file=os.path.join(workdir, "access_log.offset"),
+                        reaper_in_api=False)
+    with open(settings.xray_config_path, "w") as f:
+        json.dump({"inbounds": [{"port": 443, "protocol": "vless", "tag": "vless-in",
+                                 "settings": {"clients": [], "decryption": "none"}}], "outbounds": []}, f)
+
+    manager = mv.VPNManager(settings)
+    if fake is None:
+        manager.xray_api = CLIOnlyXrayAPI(api_addr)
+    return manager, fake
+
+
+def prepare_traffic(manager, fake, users, workdir, active_every=10):
+    """Makes every `active_every`-th user show traffic on the next collect."""
+    names = [f"seed_{i}" for i in range(users)]
+    if fake is not None:
+        for i, name in enumerate(names):
+            fake.add_traffic(name, *((1000, 5000) if i % active_every == 0 else (0, 0)))
+        return
+    stats = []
+    for i, name in enumerate(names[::active_every]):
+        stats.append({"name": f"user>>>{name}>>>traffic>>>uplink", "value": "1000"})
+        stats.append({"name": f"user>>>{name}>>>traffic>>>downlink", "value": "5000"})
+    with open(os.environ["BENCH_XRAY_STATS"], "w") as f:
+        json.dump({"stat": stats}, f)
+
+
+def access_log_ingest(manager, users, workdir, lines=100000):
+    """Appends `lines` accepted-connection lines for seeded users; returns (poll seconds, flush seconds)."""
+    from access_log import AccessLogTailer
+    path = os.path.join(workdir, "access.log")
+    open(path, "w").close()
+    tailer = AccessLogTailer(manager, path)
+    tailer.poll()
+    stamp = time.strftime("%Y/%m/%d %H:%M:%S")
+    with open(path, "w") as f:
+        f.writelines(f"{stamp}.000000 from 10.0.{i % 250}.{i % 200}:40000 accepted tcp:www.google.com:443 "
+                     f"[vless-in >> direct] email: seed_{i % users}\n" for i in range(lines))
+    poll = timed(tailer.poll)
+    flush = timed(tailer.flush)
+    tailer.close()
+    return poll, flush
+
+
+async def api_load(manager, users, ops, concurrency):
+    """Concurrent create/list/delete through the real app and MutationQueue, in-process."""
+    import httpx
+    from api_server import create_app
+
+    key = "bench-key"
+    with open(manager.settings.api_key_file, "w") as f:
+        f.write(key + "\n")
+
+    app = create_app(manager=manager)
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url="http://bench", headers={"X-API-KEY": key}) as client:
+        async def one(i):
+            async with sem:
+                for method, url, body in (("POST", "/user", {"username": f"api_{i}"}),
+                                          ("GET", "/users?limit=100", None),
+                                          ("DELETE", f"/user/api_{i}", None)):
+                    start = time.perf_counter()
+                    res = await client.request(method, url, json=body)
+                    latencies.append(time.perf_counter() - start)
+                    res.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(ops)))
+        elapsed = time.perf_counter() - start
+    return latencies, elapsed
+
+
+def run_size(users, xray_mode, ops, concurrency):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        manager, fake = setup(workdir, xray_mode)
+        try:
+            # Seed without live updates: one config write instead of `users` gRPC calls
+            manager.live_updates = False
+            results.append(summarize(users, "seed", [timed(manager.apply_batch,
+                                                           creates=[{"username": f"seed_{i}"} for i in range(users)])]))
+            manager.live_updates = True
+
+            results.append(summarize(users, "create", [timed(manager.create_user, f"bench_{i}") for i in range(ops)]))
+            results.append(summarize(users, "delete", [timed(manager.delete_user, f"bench_{i}") for i in range(ops)]))
+
+            reps = max(3, min(20, 200000 // users))
+            results.append(summarize(users, "list_full", [timed(manager.get_users) for _ in range(reps)]))
+
+            def paged():
+                cursor = None
+                while True:
+                    page = manager.get_users(cursor=cursor, limit=1000)
+                    cursor = page["next_cursor"]
+                    if cursor is None:
+                        break
+            results.append(summarize(users, "list_paged_1000", [timed(paged) for _ in range(reps)]))
+            results.append(summarize(users, "stats", [timed(manager.get_stats) for _ in range(reps)]))
+
+            prepare_traffic(manager, fake, users, workdir)
+            results.append(summarize(users, "stats_ingest", [timed(manager.update_stats_from_xray)]))
+            poll, flush = access_log_ingest(manager, users, workdir)
+            results.append(summarize(users, "access_log_parse_100k", [poll]))
+            results.append(summarize(users, "access_log_flush", [flush]))
+
+            try:
+                import httpx  # noqa: F401
+            except ImportError:
+                results.append({"users": users, "scenario": "api", "skipped": "httpx not installed"})
+            else:
+                latencies, elapsed = asyncio.run(api_load(manager, users, ops, concurrency))
+                results.append(summarize(users, "api", latencies, elapsed))
+
+            results.append(summarize(users, "purge", [timed(manager.delete_transient_users)]))
+            manager.flush_config()
+            manager.close_db()
+        finally:
+            if fake is not None:
+                fake.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--xray", choices=("fake", "stub"), default="fake" if grpc is not None else "stub")
+    parser.add_argument("--ops", type=int, default=200, help="single creates/deletes and API request groups per size")
+    parser.add_argument("--concurrency", type=int, default=32, help="in-flight API request groups")
+    parser.add_argument("--out", help="write the JSON document here instead of stdout")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_size(args.users[0], args.xray, args.ops, args.concurrency)))
+        return
+
+    results = []
+    for users in args.users:
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", "--users", str(users), "--xray", args.xray,
+               "--ops", str(args.ops), "--concurrency", str(args.concurrency)]
+        res = subprocess.run(cmd, capture_output=True, text=True)
+        if res.returncode != 0:
+            results.append({"users": users, "error": res.stderr.strip().splitlines()[-1:]})
+            continue
+        results.extend(json.loads(res.stdout.strip().splitlines()[-1]))
+
+    try:
+        revision = subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"],
+                                  capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        revision = None
+    doc = {
+        "meta": {
+            "timestamp": int(time.time()),
+            "revision": revision,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "xray": args.xray,
+            "ops": args.ops,
+            "concurrency": args.concurrency,
+        },
+        "results": results,
+    }
+    text = json.dumps(doc, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Traffic ingestion cost: one StatsService call (against fake_xray.FakeXray) + one executemany.
+
+For each user count, seeds the DB and the fake counters (only --active-pct of users moved traffic),
+then times collect_traffic() and apply_traffic_deltas() separately.
+
+Usage: python3 benchmarks/bench_stats.py [--users 1000 10000] [--active-pct 10]
+Prints one JSON object per user count. Requires grpcio.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import manage_vless as mv  # noqa: E402
+from settings import Settings  # noqa: E402
+from fake_xray import FakeXray  # noqa: E402
+
+
+class BenchManager(mv.VPNManager):
+    def _commit_config(self, adds=(), removes=(), live_limit=None):
+        pass
+
+    def _link_contexts(self, config):
+        return {None: {"mode": "reality", "address": "127.0.0.1", "port": 443, "pbk": "", "sid": ""}}
+
+
+def run(users, active_pct, workdir):
+    fake = FakeXray()
+    port = fake.start()
+    try:
+        manager = BenchManager(Settings(db_path=os.path.join(workdir, "vless.db"),
+                                        whitelist_path=os.path.join(workdir, "whitelist.txt"),
+                                        xray_config_path=os.path.join(workdir, "config.json"),
+                                        xray_api_addr=f"127.0.0.1:{port}"))
+        manager.apply_batch(creates=[{"username": f"u{i}"} for i in range(users)])
+        step = max(1, round(100 / active_pct)) if active_pct else users + 1
+        for i in range(users):
+            # Idle users still have (zero) counters in Xray
+            fake.add_traffic(f"u{i}", *((1000, 5000) if i % step == 0 else (0, 0)))
+
+        t0 = time.perf_counter()
+        deltas = manager.collect_traffic()
+        t1 = time.perf_counter()
+        changed = manager.apply_traffic_deltas(deltas)
+        t2 = time.perf_counter()
+        manager.close_db()
+    finally:
+        fake.stop()
+    return {
+        "users": users,
+        "counters": len(deltas),
+        "changed_rows": changed,
+        "collect_ms": round((t1 - t0) * 1000, 2),
+        "apply_ms": round((t2 - t1) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--active-pct", type=float, default=10)
+    args = parser.parse_args()
+    for users in args.users:
+        with tempfile.TemporaryDirectory() as workdir:
+            print(json.dumps(run(users, args.active_pct, workdir)))
+
+
+if __name__ == "__main__":
+    main()
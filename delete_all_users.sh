@@ -17,7 +17,8 @@ if [ ! -f "$API_KEY_FILE" ]; then
     exit 1
 fi
 
-API_KEY=$(cat "$API_KEY_FILE")
+# First key in the file (lines are "<key> [<name> [<requests_per_minute>]]")
+API_KEY=$(awk 'NR==1{print $1}' "$API_KEY_FILE")
 
 
 # Check for -p flag (Purge/Delete All including persistent)
@@ -0,0 +1,106 @@
+"""
+In-process stand-in for Xray's gRPC API, for tests and benchmarks (never deployed).
+
+Implements the two calls VPNManager uses: HandlerService/AlterInbound (add/remove user) and
+StatsService/QueryStats (with reset). Traffic is injected with `add_traffic()`.
+
+    fake = FakeXray()
+    port = fake.start()
+    manager.xray_api = XrayAPI(f"127.0.0.1:{port}")
+"""
+import threading
+from concurrent import futures
+from typing import Dict
+
+import grpc
+
+from xray_api import (iter_fields, _field_bytes, _field_str, _field_varint,
+                      TYPE_ADD_USER, TYPE_REMOVE_USER)
+
+
+def _fields(buf: bytes) -> Dict[int, object]:
+    # Last value wins, which is all we need for the singular fields read here
+    return {num: value for num, _, value in iter_fields(buf)}
+
+
+def _typed(buf: bytes):
+    f = _fields(buf)
+    return f.get(1, b"").decode("utf-8"), f.get(2, b"")
+
+
+class FakeXray:
+    def __init__(self):
+        self.clients = {}   # inbound tag -> {email: uuid}
+        self.counters = {}  # stat name -> value
+        self.calls = {"AlterInbound": 0, "QueryStats": 0}
+        self._lock = threading.Lock()
+        self._server = None
+
+    # --- test helpers ---
+
+    def add_traffic(self, email: str, up: int = 0, down: int = 0):
+        with self._lock:
+            for direction, value in (("uplink", up), ("downlink", down)):
+                name = f"user>>>{email}>>>traffic>>>{direction}"
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    # --- gRPC handlers ---
+
+    def _alter_inbound(self, request: bytes, context):
+        with self._lock:
+            self.calls["AlterInbound"] += 1
+            req = _fields(request)
+            tag = req.get(1, b"").decode("utf-8")
+            op_type, op = _typed(req.get(2, b""))
+            clients = self.clients.setdefault(tag, {})
+            if op_type == TYPE_ADD_USER:
+                user = _fields(_fields(op).get(1, b""))
+                email = user.get(2, b"").decode("utf-8")
+                _, account = _typed(user.get(3, b""))
+                if email in clients:
+                    context.abort(grpc.StatusCode.UNKNOWN, f"User {email} already exists.")
+                clients[email] = _fields(account).get(1, b"").decode("utf-8")
+            elif op_type == TYPE_REMOVE_USER:
+                email = _fields(op).get(1, b"").decode("utf-8")
+                if email not in clients:
+                    context.abort(grpc.StatusCode.UNKNOWN, f"User {email} not found.")
+                del clients[email]
+            else:
+                context.abort(grpc.StatusCode.UNIMPLEMENTED, f"Unknown operation {op_type}")
+        return b""
+
+    def _query_stats(self, request: bytes, context):
+        req = _fields(request)
+        pattern = req.get(1, b"").decode("utf-8")
+        reset = bool(req.get(2, 0))
+        out = bytearray()
+        with self._lock:
+            self.calls["QueryStats"] += 1
+            for name, value in self.counters.items():
+                if pattern in name:
+                    out += _field_bytes(1, _field_str(1, name) + _field_varint(2, value))
+                    if reset:
+                        self.counters[name] = 0
+        return bytes(out)
+
+    # --- lifecycle ---
+
+    def start(self, addr: str = "127.0.0.1:0") -> int:
+        """Starts serving; returns the bound port."""
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        self._server.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler("xray.app.proxyman.command.HandlerService", {
+                "AlterInbound": grpc.unary_unary_rpc_method_handler(self._alter_inbound),
+            }),
+            grpc.method_handlers_generic_handler("xray.app.stats.command.StatsService", {
+                "QueryStats": grpc.unary_unary_rpc_method_handler(self._query_stats),
+            }),
+        ))
+        port = self._server.add_insecure_port(addr)
+        self._server.start()
+        return port
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop(0)
+            self._server = None
@@ -0,0 +1,289 @@
+"""
+Fleet mode: one control API placing users on many Xray servers.
+
+A Fleet holds N backends behind one interface:
+    LocalBackend        - a VPNManager on this host (live gRPC updates, or file + restart with live=False)
+    RemoteAgentBackend  - another node's api_server.py, over HTTP with its API key
+New users are placed by a scheduler (least-loaded on live activity, or consistent hashing on the
+username), and every multi-node operation fans out to the nodes concurrently.
+
+Configured from .env (see settings.py) by fleet_from_settings():
+    FLEET_NODES=local,eu1=http://10.0.0.2:8000,us1=http://10.0.0.3:8000
+                (local-file instead of local: this host without gRPC, always write + restart)
+    FLEET_API_KEY=<key accepted by the remote agents>
+    FLEET_SCHEDULER=least_loaded|consistent_hash
+"""
+import bisect
+import hashlib
+import json
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from manage_vless import VPNManager
+
+# Seconds node load figures are reused before the scheduler asks the nodes again
+LOAD_REFRESH_INTERVAL = 10.0
+
+
+class BackendError(Exception):
+    pass
+
+
+class Backend:
+    """Interface every node type implements."""
+    name = ""
+
+    def apply_batch(self, creates: List[Dict], deletes: List[str]) -> Dict:
+        """Same contract as VPNManager.apply_batch."""
+        raise NotImplementedError
+
+    def usernames(self) -> List[str]:
+        raise NotImplementedError
+
+    def load(self) -> Dict:
+        """{"users": total users, "active": users active in the last hour}"""
+        raise NotImplementedError
+
+
+class LocalBackend(Backend):
+    def __init__(self, manager: VPNManager, name: str = "local", live: bool = True, apply=None):
+        self.name = name
+        self.manager = manager
+        # live=False: this backend's batches always rewrite config.json + restart (the local file backend).
+        # Only fleet calls are affected; the manager's other users keep live updates.
+        self.live_limit = None if live else 0
+        # api_server.py passes a function that routes the batch through its MutationQueue
+        self._apply = apply or manager.apply_batch
+
+    def apply_batch(self, creates, deletes):
+        return self._apply(creates=creates, deletes=deletes, live_limit=self.live_limit)
+
+    def usernames(self):
+        return [u["username"] for u in self.manager.iter_users(fields=["username"])]
+
+    def load(self):
+        stats = self.manager.get_stats()
+        return {"users": stats["total_users"], "active": stats["active_users_last_1h"]}
+
+
+class RemoteAgentBackend(Backend):
+    """A node running api_server.py; uses its /users/batch, /users and /stats endpoints."""
+
+    def __init__(self, name: str, url: str, api_key: str, timeout: float = 30.0):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str, body: Optional[Dict] = None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.url + path, data=data, method=method,
+                                     headers={"X-API-KEY": self.api_key, "Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as res:
+                return res.read()
+        except (urllib.error.URLError, OSError) as e:
+            raise BackendError(f"{self.name}: {method} {path} failed: {e}") from e
+
+    def apply_batch(self, creates, deletes):
+        return json.loads(self._request("POST", "/users/batch", {"creates": creates, "deletes": deletes}))
+
+    def usernames(self):
+        body = self._request("GET", "/users?" + urllib.parse.urlencode({"fields": "username", "format": "ndjson"}))
+        return [json.loads(line)["username"] for line in body.splitlines() if line.strip()]
+
+    def load(self):
+        stats = json.loads(self._request("GET", "/stats"))
+        return {"users": stats["total_users"], "active": stats["active_users_last_1h"]}
+
+
+class LeastLoadedScheduler:
+    """Picks the node with the fewest recently active users (then fewest users)."""
+
+    def __init__(self, fleet: "Fleet"):
+        self.fleet = fleet
+
+    def pick(self, username: Optional[str]) -> str:
+        loads = self.fleet.loads()
+        name = min(loads, key=lambda n: (loads[n]["active"], loads[n]["users"]))
+        # Count the assignment now so a burst of creates spreads out before the next refresh
+        loads[name]["users"] += 1
+        loads[name]["active"] += 1
+        return name
+
+
+class ConsistentHashScheduler:
+    """Hash ring with virtual nodes: a username always maps to the same node while the node set is unchanged."""
+
+    def __init__(self, fleet: "Fleet", replicas: int = 100):
+        self._ring = sorted((self._hash(f"{name}#{i}"), name) for name in fleet.backends for i in range(replicas))
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+    def pick(self, username: str) -> str:
+        i = bisect.bisect(self._keys, self._hash(username)) % len(self._ring)
+        return self._ring[i][1]
+
+
+SCHEDULERS = {"least_loaded": LeastLoadedScheduler, "consistent_hash": ConsistentHashScheduler}
+
+
+class Fleet:
+    def __init__(self, backends: List[Backend], scheduler: str = "least_loaded"):
+        if not backends:
+            raise ValueError("Fleet needs at least one backend")
+        self.backends = {b.name: b for b in backends}
+        self.executor = ThreadPoolExecutor(max_workers=max(4, len(backends)))
+        self.placement: Dict[str, str] = {}  # username -> node name
+        self._loads: Dict[str, Dict] = {}
+        self._loads_at = 0.0
+        self._loads_refreshing = False
+        self._lock = threading.Lock()
+        self.scheduler = SCHEDULERS[scheduler](self)
+
+    def _fan_out(self, fn, names=None) -> Dict[str, object]:
+        """Runs fn(backend) on the given nodes (default: all) concurrently. Failures come back as BackendError."""
+        names = list(names if names is not None else self.backends)
+        futures = {name: self.executor.submit(fn, self.backends[name]) for name in names}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e if isinstance(e, BackendError) else BackendError(f"{name}: {e}")
+        return results
+
+    def loads(self) -> Dict[str, Dict]:
+        with self._lock:
+            # One caller refreshes; the others keep using the previous figures meanwhile (unless there are none)
+            refresh = time.monotonic() - self._loads_at >= LOAD_REFRESH_INTERVAL and \
+                (not self._loads_refreshing or not self._loads)
+            if refresh:
+                self._loads_refreshing = True
+        if refresh:
+            # Outside the lock: a slow node must not hold up placement lookups in create/delete_users
+            try:
+                fresh = self._fan_out(lambda b: b.load())
+            finally:
+                with self._lock:
+                    self._loads_refreshing = False
+            with self._lock:
+                self._loads = {n: l for n, l in fresh.items() if not isinstance(l, Exception)}
+                self._loads_at = time.monotonic()
+        with self._lock:
+            if not self._loads:
+                raise BackendError("No fleet node is reachable")
+            return self._loads
+
+    def refresh_placement(self):
+        """Rebuilds username -> node from every node's user list."""
+        placement = {}
+        for name, users in self._fan_out(lambda b: b.usernames()).items():
+            if isinstance(users, Exception):
+                continue
+            for username in users:
+                placement[username] = name
+        with self._lock:
+            self.placement = placement
+
+    def create_users(self, creates: List[Dict]) -> List[Dict]:
+        """Places and creates users; each result carries its "node". Results keep the input order."""
+        groups: Dict[str, List] = {}
+        for i, item in enumerate(creates):
+            item = dict(item)
+            if not item.get("username") and isinstance(self.scheduler, ConsistentHashScheduler):
+                # The ring needs the name up front; otherwise the node names it (or hands out a pool user)
+                item["username"] = f"user_{uuid.uuid4().hex[:8]}"
+            with self._lock:
+                node = self.placement.get(item["username"]) if item.get("username") else None
+            if node is None or node not in self.backends:
+                node = self.scheduler.pick(item.get("username"))
+            groups.setdefault(node, []).append((i, item))
+
+        results: List[Optional[Dict]] = [None] * len(creates)
+        outcome = self._fan_out(lambda b: b.apply_batch([item for _, item in groups[b.name]], []), groups)
+        for node, res in outcome.items():
+            for (i, item), created in zip(groups[node], [] if isinstance(res, Exception) else res["created"]):
+                created["node"] = node
+                results[i] = created
+                if "error" not in created:
+                    with self._lock:
+                        self.placement[created["username"]] = node
+            if isinstance(res, Exception):
+                for i, item in groups[node]:
+                    results[i] = {"error": str(res), "username": item.get("username"), "node": node}
+        return results
+
+    def delete_users(self, usernames: List[str]) -> Dict:
+        """Deletes on the owning node; users with unknown placement are deleted on every node."""
+        groups: Dict[str, List[str]] = {}
+        unknown = []
+        with self._lock:
+            for username in usernames:
+                node = self.placement.get(username)
+                if node in self.backends:
+                    groups.setdefault(node, []).append(username)
+                else:
+                    unknown.append(username)
+        if unknown:
+            for name in self.backends:
+                groups.setdefault(name, []).extend(unknown)
+
+        deleted, errors = [], []
+        for node, res in self._fan_out(lambda b: b.apply_batch([], groups[b.name]), groups).items():
+            if isinstance(res, Exception):
+                errors.append(str(res))
+                continue
+            for d in res["deleted"]:
+                d["node"] = node
+                deleted.append(d)
+        with self._lock:
+            for d in deleted:
+                self.placement.pop(d["username"], None)
+        found = {d["username"] for d in deleted}
+        return {"deleted": deleted, "not_found": [u for u in usernames if u not in found], "errors": errors}
+
+    def nodes(self) -> List[Dict]:
+        """Per-node load (fresh), reachability and placed-user count."""
+        with self._lock:
+            placed: Dict[str, int] = {}
+            for node in self.placement.values():
+                placed[node] = placed.get(node, 0) + 1
+        out = []
+        for name, res in self._fan_out(lambda b: b.load()).items():
+            entry = {"node": name, "placed_users": placed.get(name, 0)}
+            if isinstance(res, Exception):
+                entry["error"] = str(res)
+            else:
+                entry.update(res)
+            out.append(entry)
+        return out
+
+
+def fleet_from_settings(local_manager: VPNManager, local_apply=None) -> Optional[Fleet]:
+    """Builds the Fleet described by the manager's FLEET_NODES setting, or None when fleet mode is off."""
+    settings = local_manager.settings
+    spec = settings.fleet_nodes.strip()
+    if not spec:
+        return None
+    api_key = settings.fleet_api_key
+    backends = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if entry in ("local", "local-file"):
+            backends.append(LocalBackend(local_manager, name="local", live=entry == "local", apply=local_apply))
+        else:
+            name, _, url = entry.partition("=")
+            backends.append(RemoteAgentBackend(name.strip(), url.strip(), api_key))
+    return Fleet(backends, scheduler=settings.fleet_scheduler)
@@ -0,0 +1,164 @@
+"""
+vless:// link generation.
+
+LinkContext caches the per-server values links need (address, mode, SNI, REALITY key/shortId) from
+the /opt/vless/*.txt files written by vless.sh, and re-reads a file only when its mtime changes.
+for_inbound() narrows them to one VLESS inbound of config.json (its port, security, SNI, shortId,
+and reality_pub_<tag>.txt when that inbound has its own REALITY key).
+It never does network I/O on the caller's thread: if server_ip.txt is missing, the public IP is
+looked up in a background thread and written to server_ip.txt for the next call.
+
+build_link()/build_links() are pure functions over a context dict, cheap enough for bulk export.
+"""
+import os
+import shutil
+import subprocess
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from metrics import OPERATIONS
+
+VLESS_DIR = "/opt/vless"
+# How often (seconds) file mtimes are re-checked; between checks the cached values are used as-is
+CHECK_INTERVAL = 1.0
+REALITY_SNI = "www.google.com" # Matches config generated by vless.sh
+
+# context key -> file name in VLESS_DIR
+FILES = {
+    "address": "server_ip.txt",
+    "mode": "connection_mode.txt",
+    "domain": "server_domain.txt",
+    "pbk": "reality_pub.txt",
+    "sid": "reality_shortid.txt",
+}
+# Public key of a REALITY inbound with its own key pair (config.json only holds the private key)
+INBOUND_PBK_FILE = "reality_pub_{tag}.txt"
+
+
+class LinkContext:
+    def __init__(self, base_dir: str = VLESS_DIR):
+        self.base_dir = base_dir
+        self._values = {key: "" for key in FILES}
+        self._mtimes = {}
+        self._extra = set() # Per-inbound files, keyed by file name in _values/_mtimes
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._ip_lookup = None
+
+    def _refresh(self):
+        for key, name in list(FILES.items()) + [(name, name) for name in self._extra]:
+            path = os.path.join(self.base_dir, name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self._mtimes.get(key, -1):
+                continue
+            self._mtimes[key] = mtime
+            value = ""
+            if mtime is not None:
+                with open(path, 'r') as f:
+                    value = f.read().strip()
+            self._values[key] = value
+        if not self._values["address"]:
+            self._start_ip_lookup()
+
+    def _start_ip_lookup(self):
+        if self._ip_lookup is not None and self._ip_lookup.is_alive():
+            return
+        self._ip_lookup = threading.Thread(target=self._lookup_public_ip, daemon=True)
+        self._ip_lookup.start()
+
+    @OPERATIONS.timed("ip_lookup")
+    def _lookup_public_ip(self):
+        try:
+            import urllib.request
+            ip = urllib.request.urlopen('https://api.ipify.org', timeout=10).read().decode('utf8').strip()
+        except Exception:
+            return
+        if ip:
+            # Same file vless.sh writes; picked up by the next mtime check
+            try:
+                with open(os.path.join(self.base_dir, FILES["address"]), 'w') as f:
+                    f.write(ip)
+            except OSError:
+                with self._lock:
+                    self._values["address"] = ip
+
+    def get(self, port: int = 443, mode: Optional[str] = None) -> Dict:
+        """Current link context for a VLESS inbound listening on `port` (mode: override connection_mode.txt)."""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked_at >= CHECK_INTERVAL:
+                self._refresh()
+                self._checked_at = now
+            values = self._values
+            address = values["address"] or "YOUR_IP"
+            mode = mode or values["mode"] or "reality"
+            ctx = {"mode": mode, "address": address, "port": port}
+            if mode == "tls":
+                # If the address is a domain, use it as SNI when server_domain.txt is not set
+                sni = values["domain"]
+                if not sni and address != "YOUR_IP" and not address[0].isdigit():
+                    sni = address
+                ctx["sni"] = sni
+            else:
+                ctx["pbk"] = values["pbk"]
+                ctx["sid"] = values["sid"]
+            return ctx
+
+    def _file_value(self, name: str) -> str:
+        """Contents of an optional file in base_dir, tracked like FILES from the first call on."""
+        with self._lock:
+            if name not in self._extra:
+                self._extra.add(name)
+                self._mtimes[name] = -1
+                self._checked_at = 0.0
+        self.get()
+        return self._values.get(name, "")
+
+    def for_inbound(self, inbound: Dict) -> Dict:
+        """Link context for one VLESS inbound from config.json; its streamSettings override the server-wide files."""
+        stream = inbound.get("streamSettings") or {}
+        security = stream.get("security")
+        ctx = self.get(inbound.get("port", 443), mode=security if security in ("tls", "reality") else None)
+        if ctx["mode"] == "tls":
+            server_name = (stream.get("tlsSettings") or {}).get("serverName")
+            if server_name:
+                ctx["sni"] = server_name
+        else:
+            reality = stream.get("realitySettings") or {}
+            if reality.get("serverNames"):
+                ctx["sni"] = reality["serverNames"][0]
+            if reality.get("shortIds") and reality["shortIds"][0]:
+                ctx["sid"] = reality["shortIds"][0]
+            if inbound.get("tag"):
+                ctx["pbk"] = self._file_value(INBOUND_PBK_FILE.format(tag=inbound["tag"])) or ctx["pbk"]
+        return ctx
+
+
+def build_link(ctx: Dict, user_uuid: str, username: str) -> str:
+    """vless:// URI for one user."""
+    server = f"{ctx['address']}:{ctx['port']}"
+    if ctx["mode"] == "tls":
+        sni_param = f"&sni={ctx['sni']}" if ctx["sni"] else ""
+        return f"vless://{user_uuid}@{server}?encryption=none&security=tls&type=tcp&headerType=none{sni_param}#{username}"
+    # Reality Link: security=reality&sni=google.com&fp=chrome&pbk=...&type=tcp
+    sni = ctx.get("sni") or REALITY_SNI
+    return f"vless://{user_uuid}@{server}?encryption=none&security=reality&sni={sni}&fp=chrome&type=tcp&pbk={ctx['pbk']}&sid={ctx['sid']}#{username}"
+
+
+def build_links(contexts: Dict[Optional[str], Dict], users: Iterable[Tuple[str, str, Optional[str]]]) -> List[Dict]:
+    """Links for many (username, uuid, inbound tag) rows at once; contexts maps tag -> context, None -> default."""
+    return [{"username": username, "uuid": user_uuid, "inbound": tag,
+             "link": build_link(contexts.get(tag) or contexts[None], user_uuid, username)}
+            for username, user_uuid, tag in users]
+
+
+def qr_code(link: str, fmt: str = "SVG") -> Optional[str]:
+    """Renders the link as a QR code with qrencode (as create_user.sh does); None if qrencode is missing."""
+    if shutil.which("qrencode") is None:
+        return None
+    res = subprocess.run(["qrencode", "-t", fmt, "-o", "-", link], capture_output=True, text=True)
+    return res.stdout if res.returncode == 0 else None
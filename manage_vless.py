@@ -3,399 +3,1102 @@ import uuid
 import os
 import sqlite3
 import subprocess
-import datetime
+import time
+import atexit
+import threading
+import contextlib
+import hashlib
+import tempfile
 from typing import Optional, List, Dict
+from xray_api import XrayAPI, XrayAPIError, user_traffic
+from links import LinkContext, build_link, build_links
+from settings import Settings
+from metrics import (OPERATIONS, PHASES, XRAY_RESTARTS, XRAY_LIVE_UPDATES, SQLITE_LOCK_WAITS,
+                     SQLITE_LOCK_TIMEOUTS, CONFIG_BYTES, CONFIG_CLIENTS)
 
-# Configuration
-XRAY_CONFIG_PATH = "/usr/local/etc/xray/config.json"
-DB_PATH = "/opt/vless/vless.db"
-WHITELIST_PATH = "/opt/vless/whitelist.txt"
+# Configuration (paths, binaries, service names) comes from settings.Settings
+# Seconds to wait before persisting config.json after a live (gRPC) change.
+# Changes arriving within this window are written together.
+CONFIG_PERSIST_DELAY = 1.0
+# SQLite tuning. WAL lets readers run alongside the single writer (API threads + cron),
+# busy_timeout makes a writer wait for the lock instead of failing with "database is locked".
+SQLITE_BUSY_TIMEOUT_MS = 5000
+# A BEGIN IMMEDIATE slower than this (seconds) had to wait for another writer (counted in /metrics)
+SQLITE_LOCK_WAIT_THRESHOLD = 0.001
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # Safe with WAL, avoids an fsync per commit
+    f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",  # ~8 MB page cache per connection
+)
+# Prepared statements kept per connection (sqlite3 caches them by SQL text)
+SQLITE_STATEMENT_CACHE = 256
+# Columns exposed by get_users/iter_users (field projection is limited to these)
+USER_FIELDS = ("id", "username", "uuid", "created_at", "traffic_up", "traffic_down", "last_active", "is_persistent",
+               "inbound_tag")
+# Raw server_stats events older than this are folded into server_stats_daily and deleted
+SERVER_STATS_RETENTION_DAYS = 30
+# Traffic time series: resolution -> (bucket seconds, retention seconds). Each one is its own
+# table (traffic_1m, ...) fed directly by apply_traffic_deltas, so no rollup job is needed.
+TRAFFIC_ROLLUPS = {
+    "1m": (60, 2 * 86400),
+    "1h": (3600, 30 * 86400),
+    "1d": (86400, 400 * 86400),
+}
+# Username under which the server-wide total of each bucket is stored (real usernames are never empty)
+SERVER_SERIES = ""
+# How new users are spread over the VLESS inbounds (Settings.inbound_policy):
+#   least_clients - the inbound with the fewest clients in config.json
+#   least_traffic - the inbound whose users moved the least traffic recently (traffic_1h, last hour or two)
+INBOUND_POLICIES = ("least_clients", "least_traffic")
+# Seconds the per-inbound traffic used by least_traffic is cached (placements are added on top meanwhile)
+INBOUND_TRAFFIC_REFRESH = 60
+# Bulk changes (reconcile, snapshot import) with more client changes than this are applied as one
+# config write + Xray restart: cheaper than that many gRPC calls
+LIVE_UPDATE_MAX_CHANGES = 500
+# Snapshot format (export_snapshot / import_snapshot): one compact row per user, columns in this order
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FIELDS = ("username", "uuid", "created_at", "last_active", "is_persistent", "is_pooled",
+                   "traffic_up", "traffic_down", "inbound_tag")
+
+# Schema migrations, applied in order by init_db. PRAGMA user_version stores how many have run.
+# Append new steps at the end; never edit a step that has already shipped.
+MIGRATIONS = [
+    # 1: initial schema
+    (
+        '''CREATE TABLE IF NOT EXISTS users
+           (id INTEGER PRIMARY KEY, username TEXT UNIQUE, uuid TEXT, 
+            created_at TIMESTAMP, traffic_up INTEGER DEFAULT 0, 
+            traffic_down INTEGER DEFAULT 0, last_active TIMESTAMP, 
+            is_persistent BOOLEAN)''',
+        '''CREATE TABLE IF NOT EXISTS server_stats
+           (id INTEGER PRIMARY KEY, timestamp TIMESTAMP, action TEXT, 
+            details TEXT)''',
+    ),
+    # 2: timestamps as integer epoch seconds instead of local datetime strings
+    (
+        "UPDATE users SET created_at = CAST(strftime('%s', created_at, 'utc') AS INTEGER) WHERE typeof(created_at) = 'text'",
+        "UPDATE users SET last_active = CAST(strftime('%s', last_active, 'utc') AS INTEGER) WHERE typeof(last_active) = 'text'",
+        "UPDATE server_stats SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE typeof(timestamp) = 'text'",
+    ),
+    # 3: indexes for the idle scan, whitelist sync and get_stats
+    (
+        "CREATE INDEX IF NOT EXISTS idx_users_persistent ON users (is_persistent)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)",
+        "CREATE INDEX IF NOT EXISTS idx_server_stats_timestamp ON server_stats (timestamp)",
+    ),
+    # 4: daily rollup of pruned server_stats events
+    (
+        '''CREATE TABLE IF NOT EXISTS server_stats_daily
+           (day INTEGER, action TEXT, events INTEGER, PRIMARY KEY (day, action)) WITHOUT ROWID''',
+    ),
+    # 5: warm pool of pre-created, unassigned users (see pool.py)
+    (
+        "ALTER TABLE users ADD COLUMN is_pooled BOOLEAN DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_users_pooled ON users (is_pooled)",
+    ),
+    # 6: traffic time series (see TRAFFIC_ROLLUPS). PK serves top-N over a time range,
+    # the username index serves per-user series.
+    (
+        '''CREATE TABLE IF NOT EXISTS traffic_1m
+           (bucket INTEGER, username TEXT, up INTEGER, down INTEGER, PRIMARY KEY (bucket, username)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS traffic_1h
+           (bucket INTEGER, username TEXT, up INTEGER, down INTEGER, PRIMARY KEY (bucket, username)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS traffic_1d
+           (bucket INTEGER, username TEXT, up INTEGER, down INTEGER, PRIMARY KEY (bucket, username)) WITHOUT ROWID''',
+        "CREATE INDEX IF NOT EXISTS idx_traffic_1m_user ON traffic_1m (username, bucket)",
+        "CREATE INDEX IF NOT EXISTS idx_traffic_1h_user ON traffic_1h (username, bucket)",
+        "CREATE INDEX IF NOT EXISTS idx_traffic_1d_user ON traffic_1d (username, bucket)",
+    ),
+    # 7: VLESS inbound (tag) each user's client lives in. NULL: placed before this column existed,
+    # i.e. on the first VLESS inbound.
+    (
+        "ALTER TABLE users ADD COLUMN inbound_tag TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_users_inbound ON users (inbound_tag)",
+    ),
+]
 
 class VPNManager:
-    def __init__(self):
-        self.init_db()
+    """
+    Users, config.json and Xray of one instance, as described by `settings`.
+    Construction does no I/O: the DB is opened (and migrated) on first use.
+    """
+
+    def __init__(self, settings: Optional[Settings] = None):
+        self.settings = settings or Settings()
+        self.xray_api = XrayAPI(self.settings.xray_api_addr)
+        # False: never use the gRPC API, every change is a config.json write + restart
+        self.live_updates = True
+        self.link_context = LinkContext(self.settings.vless_dir)
+        # Guards the resident config/index shared between request threads and the persist timer
+        self._config_lock = threading.RLock()
+        # Resident copy of config.json and its client index (see _load_index)
+        self._config = None
+        self._config_mtime = None
+        self._config_hash = None # sha256 of config.json as last read/written
+        self._vless_inbounds = []
+        self._client_maps = [] # Parallel to _vless_inbounds: {email: client}
+        self._extra_clients = [] # Parallel to _vless_inbounds: clients without an email or with a repeated one, kept as-is
+        self._inbound_positions = {} # tag -> index into _vless_inbounds
+        self._inbound_traffic = None # (monotonic time, {tag: bytes}) for least_traffic
+        self._persist_pending = False
+        self._persist_timer = None
+        # One SQLite connection per thread, reused across calls (see _db)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._schema_ready = False
+        atexit.register(self.flush_config)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.settings.db_path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=SQLITE_STATEMENT_CACHE, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        if not self._schema_ready:
+            with self._connections_lock:
+                if not self._schema_ready:
+                    self._migrate(conn)
+                    self._schema_ready = True
+        return conn
+
+    def _db(self) -> sqlite3.Connection:
+        """Returns this thread's pooled connection, opening and tuning it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Write transaction on this thread's connection. BEGIN IMMEDIATE takes the write lock up front,
+        so concurrent writers queue on busy_timeout instead of failing on a read->write lock upgrade.
+        """
+        conn = self._db()
+        start = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            SQLITE_LOCK_TIMEOUTS.inc()
+            raise
+        waited = time.perf_counter() - start
+        PHASES.observe(waited, "sqlite", "begin_immediate")
+        if waited > SQLITE_LOCK_WAIT_THRESHOLD:
+            SQLITE_LOCK_WAITS.inc()
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def close_db(self):
+        """Closes every pooled connection (e.g. on shutdown)."""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
 
     def init_db(self):
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                     (id INTEGER PRIMARY KEY, username TEXT UNIQUE, uuid TEXT, 
-                      created_at TIMESTAMP, traffic_up INTEGER DEFAULT 0, 
-                      traffic_down INTEGER DEFAULT 0, last_active TIMESTAMP, 
-                      is_persistent BOOLEAN)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS server_stats
-                     (id INTEGER PRIMARY KEY, timestamp TIMESTAMP, action TEXT, 
-                      details TEXT)''')
+        """Opens the DB now instead of on first use (the schema is created/upgraded then)."""
+        self._db()
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection):
+        """Creates/upgrades the schema by running any MIGRATIONS newer than the DB's user_version."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute(f"PRAGMA user_version = {target}")
+        except BaseException:
+            conn.rollback()
+            raise
         conn.commit()
-        conn.close()
+
+    @OPERATIONS.timed("prune_server_stats")
+    def prune_server_stats(self, retention_days: int = SERVER_STATS_RETENTION_DAYS) -> int:
+        """Rolls server_stats events older than retention_days up into per-day counts, then deletes them."""
+        cutoff = int(time.time()) - retention_days * 86400
+        with self._transaction() as c:
+            c.execute('''INSERT INTO server_stats_daily (day, action, events)
+                         SELECT timestamp - timestamp % 86400, action, count(*) FROM server_stats
+                         WHERE timestamp < ? GROUP BY 1, 2
+                         ON CONFLICT (day, action) DO UPDATE SET events = events + excluded.events''', (cutoff,))
+            c.execute("DELETE FROM server_stats WHERE timestamp < ?", (cutoff,))
+            return c.rowcount
+
+    @OPERATIONS.timed("prune_traffic")
+    def prune_traffic(self) -> int:
+        """Drops time-series buckets older than each resolution's retention. Returns rows deleted."""
+        now = int(time.time())
+        deleted = 0
+        with self._transaction() as c:
+            for name, (_, retention) in TRAFFIC_ROLLUPS.items():
+                c.execute(f"DELETE FROM traffic_{name} WHERE bucket < ?", (now - retention,))
+                deleted += c.rowcount
+        return deleted
 
     def _sync_whitelist_file(self):
         """Syncs DB persistent users to whitelist.txt for legacy/backup support"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE is_persistent = 1")
-        users = [r[0] for r in c.fetchall()]
-        conn.close()
+        users = [r[0] for r in self._db().execute("SELECT username FROM users WHERE is_persistent = 1")]
         try:
-            with open(WHITELIST_PATH, 'w') as f:
+            with open(self.settings.whitelist_path, 'w') as f:
                 f.write('\n'.join(users))
         except:
             pass
 
+    def _load_index(self):
+        """
+        Loads config.json into the resident index (email -> client per VLESS inbound).
+        Only re-reads the file when its mtime changed since the last load. While a background
+        persist is pending the in-memory copy is newer than the file, so it is kept.
+        """
+        try:
+            mtime = os.stat(self.settings.xray_config_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._config is not None and (self._persist_pending or mtime == self._config_mtime):
+            return
+
+        start = time.perf_counter()
+        if mtime is None:
+            config = {"inbounds": [], "outbounds": []} # Default empty
+            digest = None
+        else:
+            with open(self.settings.xray_config_path, 'rb') as f:
+                data = f.read()
+            config = json.loads(data)
+            digest = hashlib.sha256(data).digest()
+            CONFIG_BYTES.set(len(data))
+        self._config = config
+        self._config_mtime = mtime
+        self._config_hash = digest
+        self._vless_inbounds = [i for i in config.get("inbounds", []) if i.get("protocol") == "vless"]
+        self._client_maps, self._extra_clients = [], []
+        for inbound in self._vless_inbounds:
+            clients, extras = {}, []
+            for cl in inbound["settings"]["clients"]:
+                email = cl.get("email")
+                # Xray allows clients without an email; they (and repeats of an email) are not ours
+                # to index, but are written back unchanged
+                if email and email not in clients:
+                    clients[email] = cl
+                else:
+                    extras.append(cl)
+            self._client_maps.append(clients)
+            self._extra_clients.append(extras)
+        self._inbound_positions = {}
+        for pos, inbound in enumerate(self._vless_inbounds):
+            if inbound.get("tag"):
+                self._inbound_positions.setdefault(inbound["tag"], pos)
+        CONFIG_CLIENTS.set(sum(len(m) for m in self._client_maps))
+        PHASES.observe(time.perf_counter() - start, "config", "load")
+
+    def _sync_clients_lists(self):
+        """Writes the index back into the inbounds' `clients` lists (once per save, not per change)."""
+        for inbound, clients, extras in zip(self._vless_inbounds, self._client_maps, self._extra_clients):
+            inbound["settings"]["clients"] = list(clients.values()) + extras
+
     def get_xray_config(self) -> Dict:
-        if not os.path.exists(XRAY_CONFIG_PATH):
-            return {"inbounds": [], "outbounds": []} # Default empty
-        with open(XRAY_CONFIG_PATH, 'r') as f:
-            return json.load(f)
+        with self._config_lock:
+            self._load_index()
+            self._sync_clients_lists()
+            return self._config
 
-    def save_xray_config(self, config: Dict):
-        with open(XRAY_CONFIG_PATH, 'w') as f:
-            json.dump(config, f, indent=4)
-        # Restart Xray
-        subprocess.run(["systemctl", "restart", "xray"], check=False)
+    @staticmethod
+    def _atomic_write(path: str, data: bytes):
+        """
+        Write temp file, fsync, rename over `path`, fsync the directory: a crash leaves either the old or the new file.
+        The temp file name is unique, so concurrent writers (persist timer, another process) never share one.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".")
+        try:
+            try:
+                os.fchmod(fd, 0o644)
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+        dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
-    def create_user(self, username: Optional[str] = None, persistent: bool = False) -> Dict:
-        if not username:
-            username = f"user_{uuid.uuid4().hex[:8]}"
-        
-        user_uuid = str(uuid.uuid4())
-        
-        # 1. Update DB
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+    def save_xray_config(self, config: Dict, restart: bool = True):
+        with self._config_lock:
+            resident = config is self._config
+            if resident:
+                self._sync_clients_lists()
+            # Compact JSON: pretty-printing roughly doubles the size of a large clients list
+            with PHASES.time("save_config", "serialize"):
+                data = json.dumps(config, separators=(",", ":")).encode("utf-8")
+                digest = hashlib.sha256(data).digest()
+            # Identical to what is on disk (and what Xray last loaded): no write, no restart
+            changed = digest != self._config_hash or not os.path.exists(self.settings.xray_config_path)
+            if changed:
+                with PHASES.time("save_config", "write"):
+                    self._atomic_write(self.settings.xray_config_path, data)
+                self._config_hash = digest
+                CONFIG_BYTES.set(len(data))
+                if resident:
+                    # Our own write must not trigger a reload of the index
+                    self._config_mtime = os.stat(self.settings.xray_config_path).st_mtime_ns
+                else:
+                    self._config = None
+            # This write supersedes any pending background persist. Only cleared once it is on disk:
+            # if the write above raised, the persist stays pending (and its timer scheduled)
+            self._persist_pending = False
+            if self._persist_timer is not None:
+                self._persist_timer.cancel()
+                self._persist_timer = None
+        if changed and restart:
+            self._restart_xray()
+
+    def _restart_xray(self):
+        XRAY_RESTARTS.inc()
+        with PHASES.time("save_config", "restart"):
+            subprocess.run(["systemctl", "restart", self.settings.xray_service], check=False)
+
+    def _schedule_persist(self):
+        """Background reconcile: write config.json later, without restarting Xray.
+        Used after the running Xray was already updated through the API."""
+        with self._config_lock:
+            self._persist_pending = True
+            if self._persist_timer is None:
+                self._persist_timer = threading.Timer(CONFIG_PERSIST_DELAY, self.flush_config)
+                self._persist_timer.daemon = True
+                self._persist_timer.start()
+
+    def flush_config(self):
+        """
+        Writes a pending config to disk now (also called at interpreter exit).
+        A failed write is retried after CONFIG_PERSIST_DELAY: the running Xray already has the
+        change, so giving up would lose it at the next restart.
+        """
+        with self._config_lock:
+            if not self._persist_pending:
+                return
+            # Whichever timer is scheduled (possibly the one running us) is replaced by a retry on failure
+            if self._persist_timer is not None:
+                self._persist_timer.cancel()
+                self._persist_timer = None
+            try:
+                self.save_xray_config(self._config, restart=False)
+            except Exception as e:
+                print(f"Persisting config.json failed, retrying in {CONFIG_PERSIST_DELAY}s: {e}")
+                self._schedule_persist()
+
+    def _apply_live(self, adds=(), removes=()) -> bool:
+        """Pushes client changes to the running Xray via HandlerService.
+        adds: (inbound_tag, email, uuid) tuples, removes: (inbound_tag, email) tuples.
+        Returns False if the live path is unusable, so the caller falls back to write + restart."""
+        if not self.live_updates or not self.xray_api.available():
+            return False
         try:
-            c.execute("INSERT INTO users (username, uuid, created_at, last_active, is_persistent) VALUES (?, ?, ?, ?, ?)",
-                      (username, user_uuid, datetime.datetime.now(), datetime.datetime.now(), persistent))
-            conn.commit()
-            
-            # Log stat
-            bg_user_count = c.execute("SELECT count(*) FROM users").fetchone()[0]
-            c.execute("INSERT INTO server_stats (timestamp, action, details) VALUES (?, ?, ?)",
-                      (datetime.datetime.now(), "create", f"User created: {username}. Total: {bg_user_count}"))
-            conn.commit()
-        except sqlite3.IntegrityError:
-            # User already exists
-            existing = c.execute("SELECT uuid FROM users WHERE username = ?", (username,)).fetchone()
-            if existing:
-                user_uuid = existing[0]
-            else:
-                conn.close()
-                return {"error": "User collision error", "username": username}
-            # Continue execution to return link
-        conn.close()
-
-        if persistent:
-            self._sync_whitelist_file()
-
-        # 2. Update Xray Config
-        config = self.get_xray_config()
-        # Ensure VLESS inbound exists
-        vless_inbound = next((i for i in config.get("inbounds", []) if i.get("protocol") == "vless"), None)
-        if not vless_inbound:
-            # Create default VLESS inbound if missing (simplified for brevity, assumes config exists mostly)
-            # Fetching port 443 inbound usually
-            pass # Assumes setup_vless.sh created the structure.
-            
-        # Add client to first VLESS inbound
-        for inbound in config.get("inbounds", []):
-            if inbound["protocol"] == "vless":
-                clients = inbound["settings"]["clients"]
-                # Check if user exists in config
-                user_found = False
-                for client in clients:
-                    if client.get("email") == username:
-                        user_found = True
-                        # Update UUID if different (should not happen usually but good for sync)
-                        if client.get("id") != user_uuid:
-                            client["id"] = user_uuid
-                        break
-                
-                if not user_found:
-                    clients.append({"id": user_uuid, "email": username})
-                break
-        
-        self.save_xray_config(config)
-        
-        # Get Server IP/Domain based on preference
-        # If server_ip.txt contains a domain (has dots and not an IP, mostly), use it?
-        # User said "update the .../server_ip.txt to the domain then it should work".
-        # So we trust server_ip.txt content as the address.
-        server_address = "YOUR_IP"
-        ip_file = "/opt/vless/server_ip.txt"
-        
-        if os.path.exists(ip_file):
-            with open(ip_file, 'r') as f:
-                server_address = f.read().strip()
-        
-        # Fallback
-        if server_address == "YOUR_IP" or not server_address:
-             try:
-                import urllib.request
-                server_address = urllib.request.urlopen('https://api.ipify.org').read().decode('utf8').strip()
-             except: pass
-
-        # Check Mode
-        mode = "reality"
-        if os.path.exists("/opt/vless/connection_mode.txt"):
-            with open("/opt/vless/connection_mode.txt", 'r') as f:
-                mode = f.read().strip()
-
-        # Find Port from Config
-        server_port = 443
+            with PHASES.time("commit_config", "live_update"):
+                for tag, email in removes:
+                    if not tag:
+                        return False
+                    self.xray_api.remove_user(tag, email)
+                for tag, email, user_uuid in adds:
+                    if not tag:
+                        return False
+                    self.xray_api.add_user(tag, email, user_uuid)
+        except XrayAPIError as e:
+            print(f"Xray API update failed, falling back to restart: {e}")
+            XRAY_LIVE_UPDATES.inc("error")
+            return False
+        XRAY_LIVE_UPDATES.inc("ok")
+        return True
+
+    def _commit_config(self, adds=(), removes=(), live_limit: Optional[int] = None):
+        """
+        Applies a change made to the resident config: live via the API + background persist, or write + restart.
+        More than `live_limit` client changes always take the write + restart path.
+        """
+        CONFIG_CLIENTS.set(sum(len(m) for m in self._client_maps))
+        if live_limit is not None and len(adds) + len(removes) > live_limit:
+            self.save_xray_config(self._config)
+        elif self._apply_live(adds, removes):
+            self._schedule_persist()
+        else:
+            self.save_xray_config(self._config)
+
+    def _link_contexts(self, config: Dict) -> Dict[Optional[str], Dict]:
+        """
+        Cached link settings (see links.LinkContext) per VLESS inbound tag.
+        None maps to the first VLESS inbound, where users without an inbound_tag live.
+        """
+        contexts = {}
         for inbound in config.get("inbounds", []):
             if inbound.get("protocol") == "vless":
-                server_port = inbound.get("port", 443)
-                break
-
-        if mode == "tls":
-            # TLS Mode
-            # Get SNI Domain
-            sni_domain = ""
-            domain_file = "/opt/vless/server_domain.txt"
-            if os.path.exists(domain_file):
-                with open(domain_file, 'r') as f:
-                    sni_domain = f.read().strip()
-            
-            # If server_address is a domain, use it as SNI default if sni not set
-            if not sni_domain and not server_address[0].isdigit():
-                 sni_domain = server_address
-
-            sni_param = f"&sni={sni_domain}" if sni_domain else ""
-            link = f"vless://{user_uuid}@{server_address}:{server_port}?encryption=none&security=tls&type=tcp&headerType=none{sni_param}#{username}"
-        
-        else:
-            # REALITY Mode
-            # Need Public Key
-            pbk = ""
-            if os.path.exists("/opt/vless/reality_pub.txt"):
-                with open("/opt/vless/reality_pub.txt", 'r') as f:
-                    pbk = f.read().strip()
-            
-            # Need ShortId
-            sid = ""
-            if os.path.exists("/opt/vless/reality_shortid.txt"):
-                with open("/opt/vless/reality_shortid.txt", 'r') as f:
-                    sid = f.read().strip()
-
-            sni_server = "www.google.com" # Matches config
-            # Reality Link: security=reality&sni=google.com&fp=chrome&pbk=...&type=tcp
-            link = f"vless://{user_uuid}@{server_address}:{server_port}?encryption=none&security=reality&sni={sni_server}&fp=chrome&type=tcp&pbk={pbk}&sid={sid}#{username}"
+                ctx = self.link_context.for_inbound(inbound)
+                contexts.setdefault(None, ctx)
+                if inbound.get("tag"):
+                    contexts.setdefault(inbound["tag"], ctx)
+        if None not in contexts:
+            contexts[None] = self.link_context.get()
+        return contexts
+
+    def _client_position(self, username: str) -> Optional[int]:
+        """Index of the VLESS inbound whose clients include `username` (resident index), or None."""
+        for pos, clients in enumerate(self._client_maps):
+            if username in clients:
+                return pos
+        return None
+
+    def _inbound_loads(self, tags: List[str]) -> Dict[str, int]:
+        """
+        Recent bytes (up + down) per inbound for least_traffic, cached for INBOUND_TRAFFIC_REFRESH seconds.
+        The cached dict itself is returned: placements add to it until the next refresh.
+        """
+        now = time.monotonic()
+        if self._inbound_traffic is None or now - self._inbound_traffic[0] >= INBOUND_TRAFFIC_REFRESH:
+            since = (int(time.time()) // 3600 - 1) * 3600
+            rows = self._db().execute(
+                "SELECT u.inbound_tag, SUM(t.up + t.down) FROM traffic_1h t JOIN users u ON u.username = t.username "
+                "WHERE t.bucket >= ? GROUP BY u.inbound_tag", (since,)).fetchall()
+            first = self._vless_inbounds[0].get("tag") if self._vless_inbounds else None
+            traffic = {}
+            for tag, total in rows:
+                # No tag: placed on the first inbound before inbound_tag existed
+                tag = tag or first
+                traffic[tag] = traffic.get(tag, 0) + (total or 0)
+            self._inbound_traffic = (now, traffic)
+        traffic = self._inbound_traffic[1]
+        for tag in tags:
+            traffic.setdefault(tag, 0)
+        return traffic
+
+    def _inbound_picker(self):
+        """
+        Returns pick() -> tag of the VLESS inbound the next new user goes to, per settings.inbound_policy,
+        among the tagged inbounds allowed by settings.inbound_tags. Each pick counts towards that
+        inbound's load, so one batch is spread too. pick() returns None when no inbound is tagged
+        (the user then goes to the first VLESS inbound, as before).
+        """
+        allowed = {t.strip() for t in self.settings.inbound_tags.split(",") if t.strip()}
+        with self._config_lock:
+            self._load_index()
+            counts = {}
+            for inbound, clients in zip(self._vless_inbounds, self._client_maps):
+                tag = inbound.get("tag")
+                if tag and (not allowed or tag in allowed):
+                    counts.setdefault(tag, len(clients))
+            if self.settings.inbound_policy == "least_traffic" and counts:
+                loads = self._inbound_loads(list(counts))
+                # A new user is assumed to move as much as the average client does
+                step = max(1, sum(loads.values()) // max(1, sum(counts.values())))
+            else:
+                loads, step = counts, 1
+
+        def pick() -> Optional[str]:
+            if not counts:
+                return None
+            tag = min(counts, key=loads.get)
+            loads[tag] += step
+            return tag
+
+        return pick
+
+    def _make_link(self, ctx: Dict, user_uuid: str, username: str) -> str:
+        return build_link(ctx, user_uuid, username)
+
+    @OPERATIONS.timed("apply_batch")
+    def apply_batch(self, creates: Optional[List[Dict]] = None, deletes: Optional[List[str]] = None,
+                    live_limit: Optional[int] = None) -> Dict:
+        """
+        Applies any number of creates and deletes together:
+        one SQLite transaction, one config commit (one write + at most one reload), one whitelist sync.
+        creates: [{"username": str|None, "persistent": bool, "pooled": bool}], deletes: [username].
+        Deletes are applied before creates. "created" results are in the same order as `creates`.
+        A create without a username claims a warm pool user if one is left (no Xray change at all);
+        "pooled": True creates an unassigned pool user instead.
+        live_limit: see _commit_config (0 = this batch is always written + restarted, never pushed live).
+        """
+        creates = list(creates or [])
+        deletes = list(dict.fromkeys(deletes or [])) # De-duplicate, keep order
+
+        # 1. DB (single transaction)
+        now = int(time.time())
+        deleted, not_found = [], []
+        created = [] # (username, uuid, inbound tag)
+        outcomes = [] # Per input create, in order: index into `created`, or an error dict
+        pick_inbound = self._inbound_picker() if creates else None
+        log_rows = []
+        whitelist_dirty = False
+        start = time.perf_counter()
+        with self._transaction() as c:
+            for username in deletes:
+                c.execute("DELETE FROM users WHERE username = ?", (username,))
+                if c.rowcount > 0:
+                    deleted.append(username)
+                else:
+                    not_found.append(username)
+                log_rows.append(("delete", f"User deleted: {username}"))
+            whitelist_dirty = bool(deletes)
+
+            pool_added = 0
+            for item in creates:
+                persistent = bool(item.get("persistent", False))
+                pooled = bool(item.get("pooled", False))
+                if not item.get("username") and not pooled:
+                    # Claim a pre-created user: already in the config, so it only changes in the DB
+                    row = c.execute("SELECT id, username, uuid, inbound_tag FROM users WHERE is_pooled = 1 ORDER BY id LIMIT 1").fetchone()
+                    if row:
+                        c.execute("UPDATE users SET is_pooled = 0, is_persistent = ?, created_at = ?, last_active = ? WHERE id = ?",
+                                  (persistent, now, now, row[0]))
+                        log_rows.append(("create", f"User created: {row[1]} (from pool)"))
+                        whitelist_dirty = whitelist_dirty or persistent
+                        outcomes.append(len(created))
+                        created.append((row[1], row[2], row[3]))
+                        continue
+                username = item.get("username") or f"user_{uuid.uuid4().hex[:8]}"
+                user_uuid = str(uuid.uuid4())
+                tag = pick_inbound()
+                c.execute("INSERT OR IGNORE INTO users (username, uuid, created_at, last_active, is_persistent, is_pooled, inbound_tag) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (username, user_uuid, now, now, persistent, pooled, tag))
+                if c.rowcount > 0:
+                    if pooled:
+                        pool_added += 1
+                    else:
+                        log_rows.append(("create", f"User created: {username}"))
+                else:
+                    # User already exists
+                    existing = c.execute("SELECT uuid, inbound_tag FROM users WHERE username = ?", (username,)).fetchone()
+                    if not existing:
+                        outcomes.append({"error": "User collision error", "username": username})
+                        continue
+                    user_uuid, tag = existing
+                    # Continue execution to return link
+                if persistent:
+                    whitelist_dirty = True
+                outcomes.append(len(created))
+                created.append((username, user_uuid, tag))
+
+            if pool_added:
+                log_rows.append(("pool", f"Pool refilled: +{pool_added}"))
+
+            # Log stat
+            total = c.execute("SELECT count(*) FROM users WHERE is_pooled = 0").fetchone()[0]
+            c.executemany("INSERT INTO server_stats (timestamp, action, details) VALUES (?, ?, ?)",
+                          [(now, action, f"{details}. Total: {total}") for action, details in log_rows])
+
+        PHASES.observe(time.perf_counter() - start, "apply_batch", "db")
+
+        if whitelist_dirty:
+            with PHASES.time("apply_batch", "whitelist"):
+                self._sync_whitelist_file()
+
+        # 2. Xray Config (O(1) per user through the resident index, single commit)
+        removed_from_config = set()
+        start = time.perf_counter()
+        with self._config_lock:
+            self._load_index()
+            adds, removes = [], []
+
+            for username in deleted:
+                for inbound, clients in zip(self._vless_inbounds, self._client_maps):
+                    if clients.pop(username, None) is not None:
+                        removes.append((inbound.get("tag"), username))
+                        removed_from_config.add(username)
+            if removed_from_config and any(self._extra_clients):
+                # Repeated copies of a deleted user's client go with it
+                self._extra_clients = [[cl for cl in extras if cl.get("email") not in removed_from_config]
+                                       for extras in self._extra_clients]
+
+            # Add clients to their inbound (the one they are already in, else the one picked above;
+            # the first VLESS inbound if that tag is gone or untagged)
+            retag = []
+            if created and self._vless_inbounds:
+                for i, (username, user_uuid, tag) in enumerate(created):
+                    pos = self._client_position(username)
+                    if pos is None:
+                        pos = self._inbound_positions.get(tag, 0)
+                    inbound, clients = self._vless_inbounds[pos], self._client_maps[pos]
+                    client = clients.get(username)
+                    if client is None:
+                        clients[username] = {"id": user_uuid, "email": username}
+                        adds.append((inbound.get("tag"), username, user_uuid))
+                    elif client.get("id") != user_uuid:
+                        # Update UUID if different (should not happen usually but good for sync)
+                        client["id"] = user_uuid
+                        removes.append((inbound.get("tag"), username))
+                        adds.append((inbound.get("tag"), username, user_uuid))
+                    # Existing client with the same UUID: running Xray already has it, nothing to do
+                    if inbound.get("tag") != tag:
+                        created[i] = (username, user_uuid, inbound.get("tag"))
+                        retag.append((inbound.get("tag"), username))
+
+            if adds or removes:
+                self._commit_config(adds, removes, live_limit=live_limit)
+            config = self._config
+        PHASES.observe(time.perf_counter() - start, "apply_batch", "config")
+
+        if retag:
+            # Rows whose stored inbound is not where the client actually is
+            with self._transaction() as c:
+                c.executemany("UPDATE users SET inbound_tag = ? WHERE username = ?", retag)
+
+        results = []
+        if created:
+            with PHASES.time("apply_batch", "links"):
+                contexts = self._link_contexts(config)
+                results = [{"username": username, "uuid": user_uuid, "inbound": tag,
+                            "link": self._make_link(contexts.get(tag) or contexts[None], user_uuid, username)}
+                           for username, user_uuid, tag in created]
 
         return {
-            "username": username,
-            "uuid": user_uuid, 
-            "link": link
+            "created": [results[o] if isinstance(o, int) else o for o in outcomes],
+            "deleted": [{"status": "deleted" if u in removed_from_config else "deleted_from_db_only", "username": u}
+                        for u in deleted],
+            "not_found": not_found,
         }
 
-    def delete_user(self, username: str):
-        # 1. DB
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("DELETE FROM users WHERE username = ?", (username,))
-        deleted = c.rowcount > 0
-        
-        # Log
-        bg_user_count = c.execute("SELECT count(*) FROM users").fetchone()[0]
-        c.execute("INSERT INTO server_stats (timestamp, action, details) VALUES (?, ?, ?)",
-                  (datetime.datetime.now(), "delete", f"User deleted: {username}. Total: {bg_user_count}"))
-        conn.commit()
-        conn.close()
-
-        self._sync_whitelist_file()
+    @OPERATIONS.timed("create_user")
+    def create_user(self, username: Optional[str] = None, persistent: bool = False) -> Dict:
+        res = self.apply_batch(creates=[{"username": username, "persistent": persistent}])
+        return res["created"][0]
 
-        if not deleted:
+    @OPERATIONS.timed("delete_user")
+    def delete_user(self, username: str):
+        res = self.apply_batch(deletes=[username])
+        if res["not_found"]:
             return {"error": "User not found"}
-
-        # 2. Xray
-        config = self.get_xray_config()
-        changed = False
-        for inbound in config.get("inbounds", []):
-            if inbound["protocol"] == "vless":
-                new_clients = [cl for cl in inbound["settings"]["clients"] if cl["email"] != username]
-                if len(new_clients) != len(inbound["settings"]["clients"]):
-                    inbound["settings"]["clients"] = new_clients
-                    changed = True
-        
-        if changed:
-            self.save_xray_config(config)
-            return {"status": "deleted", "username": username}
-        return {"status": "deleted_from_db_only", "username": username}
+        return res["deleted"][0]
 
     def delete_transient_users(self):
-        """Deletes all non-persistent users"""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT username FROM users WHERE is_persistent = 0")
-        users_to_delete = [r[0] for r in c.fetchall()]
-        conn.close()
+        """Deletes all non-persistent users (the warm pool is kept)"""
+        users_to_delete = [r[0] for r in self._db().execute("SELECT username FROM users WHERE is_persistent = 0 AND is_pooled = 0")]
         
-        deleted_count = 0
-        deleted_users = []
-        for user in users_to_delete:
-            res = self.delete_user(user)
-            if "error" not in res:
-                deleted_count += 1
-                deleted_users.append(user)
-                
-        return {"deleted_count": deleted_count, "users": deleted_users}
+        # Large purges: one config write + restart instead of a gRPC call per user
+        res = self.apply_batch(deletes=users_to_delete, live_limit=LIVE_UPDATE_MAX_CHANGES)
+        deleted_users = [d["username"] for d in res["deleted"]]
+        return {"deleted_count": len(deleted_users), "users": deleted_users}
 
     def delete_all_users(self, force: bool = False):
-        """Deletes ALL users. If force=True, deletes whitelisted too."""
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
+        """Deletes ALL users. If force=True, deletes whitelisted too (and empties the warm pool)."""
+        c = self._db().cursor()
         if force:
             c.execute("SELECT username FROM users")
         else:
-            c.execute("SELECT username FROM users WHERE is_persistent = 0")
+            c.execute("SELECT username FROM users WHERE is_persistent = 0 AND is_pooled = 0")
         
         users_to_delete = [r[0] for r in c.fetchall()]
-        conn.close()
         
-        deleted_count = 0
-        deleted_users = []
-        for user in users_to_delete:
-            res = self.delete_user(user)
-            if "error" not in res:
-                deleted_count += 1
-                deleted_users.append(user)
-                
-        return {"deleted_count": deleted_count, "users": deleted_users}
-
-    def get_users(self):
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute("SELECT * FROM users")
-        rows = [dict(row) for row in c.fetchall()]
-        conn.close()
-        return rows
+        # Large purges: one config write + restart instead of a gRPC call per user
+        res = self.apply_batch(deletes=users_to_delete, live_limit=LIVE_UPDATE_MAX_CHANGES)
+        deleted_users = [d["username"] for d in res["deleted"]]
+        return {"deleted_count": len(deleted_users), "users": deleted_users}
+
+    @OPERATIONS.timed("reconcile")
+    def reconcile(self, dry_run: bool = False, restart: bool = False) -> Dict:
+        """
+        Makes config.json (and the running Xray) and whitelist.txt match the users table, the source of truth.
+        One pass over both sides with set operations, then a single config commit:
+          added     - users without a client (placed on their inbound_tag, else by the inbound policy)
+          removed   - clients without a user, and second copies of a client in another inbound
+          uuid_fixed - clients whose UUID differs from the DB
+          retagged  - users whose inbound_tag is not where their client is (the DB is corrected, no client moves)
+          unmanaged - clients without an email, or repeating an email within one inbound: not matched
+                      to users and left as they are (only counted)
+        dry_run only reports. restart=True restarts Xray even without changes, so the running
+        Xray is guaranteed to have loaded exactly this config.
+        """
+        db = {username: (user_uuid, tag) for username, user_uuid, tag in
+              self._db().execute("SELECT username, uuid, inbound_tag FROM users")}
+        with self._config_lock:
+            self._load_index()
+            positions = {}  # email -> inbounds (positions) holding it
+            for pos, clients in enumerate(self._client_maps):
+                for email in clients:
+                    positions.setdefault(email, []).append(pos)
+
+            add_plan, remove_plan, uuid_plan, retag = [], [], [], []
+            for email in positions.keys() - db.keys():
+                remove_plan.extend((pos, email) for pos in positions[email])
+            duplicates = 0
+            for email in positions.keys() & db.keys():
+                user_uuid, tag = db[email]
+                held = positions[email]
+                keep = self._inbound_positions.get(tag)
+                keep = keep if keep in held else held[0]
+                for pos in held:
+                    if pos != keep:
+                        remove_plan.append((pos, email))
+                        duplicates += 1
+                if self._client_maps[keep][email].get("id") != user_uuid:
+                    uuid_plan.append((keep, email, user_uuid))
+                actual = self._vless_inbounds[keep].get("tag")
+                if actual and actual != tag:
+                    retag.append((actual, email))
+            missing = db.keys() - positions.keys()
+            if missing and self._vless_inbounds:
+                pick = self._inbound_picker()
+                for email in missing:
+                    user_uuid, tag = db[email]
+                    if tag not in self._inbound_positions:
+                        picked = pick()
+                        if picked != tag:
+                            tag = picked
+                            retag.append((tag, email))
+                    add_plan.append((self._inbound_positions.get(tag, 0), email, user_uuid))
+
+            result = {
+                "dry_run": dry_run,
+                "added": sorted(email for _, email, _ in add_plan),
+                "removed": sorted({email for _, email in remove_plan}),
+                "duplicates_removed": duplicates,
+                "uuid_fixed": sorted(email for _, email, _ in uuid_plan),
+                "retagged": sorted(email for _, email in retag),
+                "unplaced": sorted(missing) if not self._vless_inbounds else [],
+                "unmanaged": sum(len(extras) for extras in self._extra_clients),
+            }
+            if dry_run:
+                return result
+
+            adds, removes = [], []
+            for pos, email in remove_plan:
+                self._client_maps[pos].pop(email, None)
+                removes.append((self._vless_inbounds[pos].get("tag"), email))
+            for pos, email, user_uuid in uuid_plan:
+                self._client_maps[pos][email]["id"] = user_uuid
+                removes.append((self._vless_inbounds[pos].get("tag"), email))
+                adds.append((self._vless_inbounds[pos].get("tag"), email, user_uuid))
+            for pos, email, user_uuid in add_plan:
+                self._client_maps[pos][email] = {"id": user_uuid, "email": email}
+                adds.append((self._vless_inbounds[pos].get("tag"), email, user_uuid))
+            if adds or removes:
+                self._commit_config(adds, removes, live_limit=LIVE_UPDATE_MAX_CHANGES)
+                restart = restart and not (len(adds) + len(removes) > LIVE_UPDATE_MAX_CHANGES)
+            if restart:
+                # The restarted Xray must read the reconciled config, not the one before the pending persist
+                self.flush_config()
+                self._restart_xray()
+
+        with self._transaction() as c:
+            if retag:
+                c.executemany("UPDATE users SET inbound_tag = ? WHERE username = ?", retag)
+            c.execute("INSERT INTO server_stats (timestamp, action, details) VALUES (?, ?, ?)",
+                      (int(time.time()), "reconcile", f"Reconciled: +{len(add_plan)} -{len(result['removed'])} "
+                                                      f"uuid {len(uuid_plan)} retag {len(retag)}"))
+        self._sync_whitelist_file()
+        return result
 
+    @OPERATIONS.timed("export_snapshot")
+    def export_snapshot(self) -> Dict:
+        """All users as compact rows (columns: SNAPSHOT_FIELDS), for import_snapshot on this or another server."""
+        rows = self._db().execute(f"SELECT {', '.join(SNAPSHOT_FIELDS)} FROM users ORDER BY id")
+        return {"version": SNAPSHOT_VERSION, "exported_at": int(time.time()), "fields": list(SNAPSHOT_FIELDS),
+                "users": [list(row) for row in rows]}
+
+    @OPERATIONS.timed("import_snapshot")
+    def import_snapshot(self, snapshot: Dict, replace: bool = False) -> Dict:
+        """
+        Loads users from export_snapshot(): one transaction (insert, or overwrite by username), then one
+        reconcile, i.e. a single config commit (write + restart for large imports) instead of a change per user.
+        Inbound tags this server does not have are re-assigned by the inbound policy.
+        replace=True also deletes users that are not in the snapshot. Raises ValueError for a malformed snapshot.
+        """
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {snapshot.get('version')}")
+        fields = list(snapshot.get("fields") or [])
+        if "username" not in fields or "uuid" not in fields:
+            raise ValueError("Snapshot fields must include username and uuid")
+        now = int(time.time())
+        defaults = {"created_at": now, "last_active": now, "is_persistent": 0, "is_pooled": 0,
+                    "traffic_up": 0, "traffic_down": 0, "inbound_tag": None}
+        index = {name: i for i, name in enumerate(fields) if name in SNAPSHOT_FIELDS}
+        pick = self._inbound_picker()
+        with self._config_lock:
+            self._load_index()
+            known_tags = set(self._inbound_positions)
+
+        rows = []
+        for row in snapshot.get("users") or []:
+            if len(row) != len(fields):
+                raise ValueError(f"Snapshot row has {len(row)} columns, expected {len(fields)}")
+            user = {name: row[i] for name, i in index.items()}
+            if not user["username"] or not isinstance(user["username"], str):
+                raise ValueError(f"Invalid username in snapshot: {user['username']!r}")
+            try:
+                user["uuid"] = str(uuid.UUID(str(user["uuid"])))
+            except ValueError:
+                raise ValueError(f"Invalid uuid for {user['username']}: {user['uuid']!r}")
+            for name, default in defaults.items():
+                if user.get(name) is None:
+                    user[name] = default
+            if user["inbound_tag"] not in known_tags:
+                user["inbound_tag"] = pick()
+            rows.append(tuple(user[name] for name in SNAPSHOT_FIELDS))
+
+        deleted = 0
+        with self._transaction() as c:
+            if replace:
+                c.execute("CREATE TEMP TABLE IF NOT EXISTS snapshot_names (username TEXT PRIMARY KEY)")
+                c.execute("DELETE FROM snapshot_names")
+                c.executemany("INSERT OR IGNORE INTO snapshot_names VALUES (?)", [(r[0],) for r in rows])
+                c.execute("DELETE FROM users WHERE username NOT IN (SELECT username FROM snapshot_names)")
+                deleted = c.rowcount
+                c.execute("DELETE FROM snapshot_names")
+            columns = ", ".join(SNAPSHOT_FIELDS)
+            updates = ", ".join(f"{name} = excluded.{name}" for name in SNAPSHOT_FIELDS[1:])
+            c.executemany(f"INSERT INTO users ({columns}) VALUES ({', '.join('?' * len(SNAPSHOT_FIELDS))}) "
+                          f"ON CONFLICT (username) DO UPDATE SET {updates}", rows)
+            c.execute("INSERT INTO server_stats (timestamp, action, details) VALUES (?, ?, ?)",
+                      (now, "import", f"Snapshot imported: {len(rows)} users" + (f", {deleted} removed" if replace else "")))
+
+        res = self.reconcile()
+        return {"imported": len(rows), "deleted": deleted,
+                "config": {key: value if isinstance(value, int) else len(value)
+                           for key, value in res.items() if key != "dry_run"}}
+
+    @OPERATIONS.timed("get_user_link")
+    def get_user_link(self, username: str) -> Optional[Dict]:
+        row = self._db().execute("SELECT uuid, inbound_tag FROM users WHERE username = ? AND is_pooled = 0", (username,)).fetchone()
+        if not row:
+            return None
+        with self._config_lock:
+            self._load_index()
+            contexts = self._link_contexts(self._config)
+        ctx = contexts.get(row[1]) or contexts[None]
+        return {"username": username, "uuid": row[0], "inbound": row[1], "link": self._make_link(ctx, row[0], username)}
+
+    @OPERATIONS.timed("export_links")
+    def export_links(self) -> List[Dict]:
+        """Links for every user (one query, one context lookup per inbound)."""
+        with self._config_lock:
+            self._load_index()
+            contexts = self._link_contexts(self._config)
+        return build_links(contexts, self._db().execute("SELECT username, uuid, inbound_tag FROM users WHERE is_pooled = 0"))
+
+    def _users_query(self, persistent: Optional[bool] = None, active_since: Optional[int] = None,
+                     idle_for: Optional[int] = None, min_traffic: Optional[int] = None,
+                     inbound: Optional[str] = None, fields: Optional[List[str]] = None,
+                     after_id: Optional[int] = None, limit: Optional[int] = None):
+        """Builds the SELECT for get_users/iter_users. Unknown fields raise ValueError."""
+        fields = list(fields or USER_FIELDS)
+        unknown = [f for f in fields if f not in USER_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        where, params = ["is_pooled = 0"], []
+        if after_id is not None:
+            where.append("id > ?")
+            params.append(after_id)
+        if persistent is not None:
+            where.append("is_persistent = ?")
+            params.append(1 if persistent else 0)
+        if active_since is not None:
+            where.append("last_active >= ?")
+            params.append(active_since)
+        if idle_for is not None:
+            where.append("last_active < ?")
+            params.append(int(time.time()) - idle_for)
+        if min_traffic is not None:
+            where.append("traffic_up + traffic_down >= ?")
+            params.append(min_traffic)
+        if inbound is not None:
+            where.append("inbound_tag = ?")
+            params.append(inbound)
+        # id is always selected (keyset cursor); it is dropped from rows unless requested
+        sql = f"SELECT id, {', '.join(fields)} FROM users WHERE " + " AND ".join(where)
+        sql += " ORDER BY id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return sql, params, fields
+
+    def iter_users(self, cursor: Optional[int] = None, limit: Optional[int] = None, **filters):
+        """
+        Yields user dicts straight from the SQLite cursor, without building the whole list.
+        Uses its own connection, so the generator may be consumed from any thread (e.g. a streaming response).
+        Accepts the same arguments as get_users.
+        """
+        sql, params, fields = self._users_query(after_id=cursor, limit=limit, **filters)
+        conn = self._connect()
+        try:
+            for row in conn.execute(sql, params):
+                yield dict(zip(fields, row[1:]))
+        finally:
+            conn.close()
+
+    @OPERATIONS.timed("get_users")
+    def get_users(self, cursor: Optional[int] = None, limit: Optional[int] = None, **filters):
+        """
+        Users as dicts. Filters: persistent (bool), active_since (epoch), idle_for (seconds),
+        min_traffic (bytes up+down), inbound (tag), fields (list of columns).
+        Without limit returns a plain list. With limit returns {"users": [...], "next_cursor": id|None};
+        pass next_cursor back as `cursor` to get the next page (keyset pagination on id).
+        """
+        sql, params, fields = self._users_query(after_id=cursor, limit=limit, **filters)
+        rows = self._db().execute(sql, params).fetchall()
+        users = [dict(zip(fields, row[1:])) for row in rows]
+        if limit is None:
+            return users
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        return {"users": users, "next_cursor": next_cursor}
+
+    @OPERATIONS.timed("get_stats")
     def get_stats(self):
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        total_users = c.execute("SELECT count(*) FROM users").fetchone()[0]
-        active_users = c.execute("SELECT count(*) FROM users WHERE last_active > ?", 
-                                 (datetime.datetime.now() - datetime.timedelta(hours=1),)).fetchone()[0]
+        c = self._db().cursor()
+        total_users = c.execute("SELECT count(*) FROM users WHERE is_pooled = 0").fetchone()[0]
+        active_users = c.execute("SELECT count(*) FROM users WHERE last_active > ? AND is_pooled = 0",
+                                 (int(time.time()) - 3600,)).fetchone()[0]
         # Get history (last 50 events)
-        c.execute("SELECT timestamp, action, details FROM server_stats ORDER BY timestamp DESC LIMIT 50")
+        c.execute("SELECT timestamp, action, details FROM server_stats ORDER BY timestamp DESC, id DESC LIMIT 50")
         history = [{"time": r[0], "action": r[1], "details": r[2]} for r in c.fetchall()]
-        conn.close()
+        # Older events only survive as per-day counts (see prune_server_stats)
+        c.execute("SELECT day, action, events FROM server_stats_daily ORDER BY day DESC LIMIT 60")
+        history_daily = [{"day": r[0], "action": r[1], "events": r[2]} for r in c.fetchall()]
         return {
             "total_users": total_users,
             "active_users_last_1h": active_users,
-            "history": history
+            "history": history,
+            "history_daily": history_daily,
+            "pooled_users": self.pool_count(),
+            "inbounds": self.inbound_counts(),
         }
 
+    def inbound_counts(self) -> List[Dict]:
+        """Clients per VLESS inbound, from the resident index."""
+        with self._config_lock:
+            self._load_index()
+            return [{"tag": inbound.get("tag"), "port": inbound.get("port"), "clients": len(clients)}
+                    for inbound, clients in zip(self._vless_inbounds, self._client_maps)]
+
+    def user_counts(self) -> Dict[str, int]:
+        """Users by state for /metrics: active (last hour) / idle / persistent / pooled."""
+        cutoff = int(time.time()) - 3600
+        active, idle, persistent, pooled = self._db().execute(
+            '''SELECT COALESCE(SUM(is_pooled = 0 AND last_active > ?), 0), COALESCE(SUM(is_pooled = 0 AND last_active <= ?), 0),
+                      COALESCE(SUM(is_persistent = 1), 0), COALESCE(SUM(is_pooled = 1), 0) FROM users''',
+            (cutoff, cutoff)).fetchone()
+        return {"active": active, "idle": idle, "persistent": persistent, "pooled": pooled}
+
+    def pool_count(self) -> int:
+        """Unassigned users in the warm pool."""
+        return self._db().execute("SELECT count(*) FROM users WHERE is_pooled = 1").fetchone()[0]
+
+    @OPERATIONS.timed("collect_traffic")
+    def collect_traffic(self) -> Dict[str, List[int]]:
+        """
+        Fetches every user's traffic counters in one StatsService call and resets them,
+        so the result is {email: [up, down]} bytes since the previous call (not cumulative
+        totals, which Xray loses on restart). Falls back to `xray api statsquery -reset` if
+        grpcio is missing. Only one collector should run, otherwise deltas get split.
+        """
+        if self.xray_api.available():
+            return user_traffic(self.xray_api.query_stats("user>>>", reset=True))
+
+        cmd = [self.settings.xray_bin, "api", "statsquery", f"--server={self.xray_api.addr}", "-pattern", "user>>>", "-reset"]
+        res = subprocess.run(cmd, capture_output=True, text=True)
+        if res.returncode != 0:
+            raise XrayAPIError(f"statsquery failed: {res.stderr.strip()}")
+        # Output is the JSON form of QueryStatsResponse; int64 values may be strings, zero values omitted
+        stats = {s["name"]: int(s.get("value", 0)) for s in json.loads(res.stdout or "{}").get("stat", [])}
+        return user_traffic(stats)
+
+    @OPERATIONS.timed("apply_traffic_deltas")
+    def apply_traffic_deltas(self, deltas: Dict[str, List[int]]) -> int:
+        """
+        Adds traffic deltas to users and bumps last_active, touching only users that moved traffic.
+        The same deltas (plus a server-wide total) are added to the current bucket of every time series.
+        """
+        now = int(time.time())
+        rows = [(up, down, now, email) for email, (up, down) in deltas.items() if up or down]
+        if not rows:
+            return 0
+        total_up = sum(r[0] for r in rows)
+        total_down = sum(r[1] for r in rows)
+        with self._transaction() as c:
+            c.executemany("UPDATE users SET traffic_up = traffic_up + ?, traffic_down = traffic_down + ?, last_active = ? WHERE username = ?",
+                          rows)
+            updated = c.rowcount
+            for name, (step, _) in TRAFFIC_ROLLUPS.items():
+                bucket = now - now % step
+                c.executemany(f'''INSERT INTO traffic_{name} (bucket, username, up, down) VALUES (?, ?, ?, ?)
+                                  ON CONFLICT (bucket, username) DO UPDATE SET up = up + excluded.up, down = down + excluded.down''',
+                              [(bucket, email, up, down) for up, down, _, email in rows] + [(bucket, SERVER_SERIES, total_up, total_down)])
+            return updated
+
+    @OPERATIONS.timed("touch_users")
+    def touch_users(self, last_seen: Dict[str, int]) -> int:
+        """Moves last_active forward to the given epochs ({username: epoch}, e.g. from the access log) in one transaction."""
+        with self._transaction() as c:
+            c.executemany("UPDATE users SET last_active = ? WHERE username = ? AND (last_active IS NULL OR last_active < ?)",
+                          [(ts, username, ts) for username, ts in last_seen.items()])
+            return c.rowcount
+
+    @staticmethod
+    def _traffic_resolution(window: int) -> str:
+        """Finest resolution whose retention still covers `window` seconds."""
+        for name, (_, retention) in TRAFFIC_ROLLUPS.items():
+            if window <= retention:
+                return name
+        return list(TRAFFIC_ROLLUPS)[-1]
+
+    @OPERATIONS.timed("traffic_top")
+    def traffic_top(self, window: int = 3600, limit: int = 20) -> List[Dict]:
+        """Users with the most traffic (up + down bytes) in the last `window` seconds."""
+        name = self._traffic_resolution(window)
+        step = TRAFFIC_ROLLUPS[name][0]
+        since = int(time.time()) - window
+        rows = self._db().execute(
+            f'''SELECT username, SUM(up), SUM(down) FROM traffic_{name}
+                WHERE bucket >= ? AND username != ? GROUP BY username
+                ORDER BY SUM(up) + SUM(down) DESC LIMIT ?''', (since - since % step, SERVER_SERIES, limit))
+        return [{"username": u, "up": up, "down": down, "total": up + down} for u, up, down in rows]
+
+    @OPERATIONS.timed("traffic_series")
+    def traffic_series(self, username: Optional[str] = None, resolution: str = "1m",
+                       since: Optional[int] = None, until: Optional[int] = None) -> List[Dict]:
+        """
+        Per-bucket traffic of one user, or of the whole server when username is None.
+        Buckets without traffic are omitted. Default range: the last 60 buckets.
+        """
+        if resolution not in TRAFFIC_ROLLUPS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        step = TRAFFIC_ROLLUPS[resolution][0]
+        until = int(time.time()) if until is None else until
+        since = until - 60 * step if since is None else since
+        rows = self._db().execute(
+            f"SELECT bucket, up, down FROM traffic_{resolution} WHERE username = ? AND bucket >= ? AND bucket <= ? ORDER BY bucket",
+            (SERVER_SERIES if username is None else username, since - since % step, until))
+        return [{"t": t, "up": up, "down": down} for t, up, down in rows]
+
+    @OPERATIONS.timed("traffic_summary")
+    def traffic_summary(self, window: int = 3600) -> Dict:
+        """Server-wide bytes and number of users that moved traffic in the last `window` seconds."""
+        name = self._traffic_resolution(window)
+        step = TRAFFIC_ROLLUPS[name][0]
+        since = int(time.time()) - window
+        since -= since % step
+        c = self._db()
+        up, down = c.execute(f"SELECT COALESCE(SUM(up), 0), COALESCE(SUM(down), 0) FROM traffic_{name} WHERE bucket >= ? AND username = ?",
+                             (since, SERVER_SERIES)).fetchone()
+        users = c.execute(f"SELECT COUNT(DISTINCT username) FROM traffic_{name} WHERE bucket >= ? AND username != ?",
+                          (since, SERVER_SERIES)).fetchone()[0]
+        return {"window": window, "resolution": name, "up": up, "down": down, "total": up + down, "active_users": users}
+
+    @OPERATIONS.timed("update_stats_from_xray")
     def update_stats_from_xray(self):
         """Called by cron to query Xray stats and update DB"""
-        # Query Xray API for all user stats
         try:
-            # We need to query 'user>>>email>>>traffic>>>downlink' and uplink
-            # This is complex with raw API. Using a simplified approach:
-            # Parse `xray api statsquery` output if available, or just check if traffic changed.
-            # Assuming `xray` binary is in path.
-            
-            # Fetch Uplink
-            cmd_up = ["/usr/local/bin/xray", "api", "statsquery", "--server=127.0.0.1:10085", "--pattern", "user>>>*>>>traffic>>>uplink"]
-            res_up = subprocess.run(cmd_up, capture_output=True, text=True)
-            
-            # Fetch Downlink
-            cmd_down = ["/usr/local/bin/xray", "api", "statsquery", "--server=127.0.0.1:10085", "--pattern", "user>>>*>>>traffic>>>downlink"]
-            res_down = subprocess.run(cmd_down, capture_output=True, text=True)
-
-            if res_up.returncode != 0 or res_down.returncode != 0:
-                print("Error querying Xray stats")
-                return
-
-            def parse_xray_output(output):
-                # Output format: "user>>>email>>>traffic>>>uplink: 12345"
-                data = {}
-                for line in output.splitlines():
-                    if "value" in line and "name" in line: # JSON format usually?
-                        pass 
-                    # Actually `xray api statsquery` returns JSONish or text depending on version.
-                    # Standard simplified output:
-                    # name: user>>>email>>>traffic>>>uplink  value: 1024
-                    parts = line.split()
-                    if len(parts) >= 4 and "name:" in line:
-                         name = parts[1]
-                         value = int(parts[3])
-                         email = name.split(">>>")[1]
-                         data[email] = value
-                return data
-
-            # Note: The output format of `xray api statsquery` depends on the tool version.
-            # Assuming standard text output. If JSON, need json.loads.
-            # Let's try to handle JSON if the command supports -json or detects it?
-            # Default is proto/text.
-            
-            # Parsing simplified text output (heuristic)
-            # "stat: user>>>foo>>>traffic>>>uplink 100"
-            
-            # Better approach:
-            # Iterate known users and query them specifically if pattern fails?
-            # No, pattern is better.
-            
-            current_uplinks = {}
-            current_downlinks = {}
-            
-            # Manual parse of standard output
-            for line in res_up.stdout.splitlines():
-                if "user>>>" in line:
-                    parts = line.strip().split()
-                    # Pattern: name: ... value: ...
-                    try:
-                        name_idx = parts.index("name:") + 1
-                        val_idx = parts.index("value:") + 1
-                        name = parts[name_idx]
-                        val = int(parts[val_idx])
-                        email = name.split(">>>")[1]
-                        current_uplinks[email] = val
-                    except:
-                        pass
-
-            for line in res_down.stdout.splitlines():
-                if "user>>>" in line:
-                    parts = line.strip().split()
-                    try:
-                        name_idx = parts.index("name:") + 1
-                        val_idx = parts.index("value:") + 1
-                        name = parts[name_idx]
-                        val = int(parts[val_idx])
-                        email = name.split(">>>")[1]
-                        current_downlinks[email] = val
-                    except:
-                        pass
-
-            # Update DB
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            users = c.execute("SELECT username, traffic_up, traffic_down, last_active FROM users").fetchall()
-            
-            for u in users:
-                username = u[0]
-                old_up = u[1]
-                old_down = u[2]
-                
-                new_up = current_uplinks.get(username, old_up)
-                new_down = current_downlinks.get(username, old_down)
-                
-                # Check for activity
-                # Note: Xray stats accumulate? Yes.
-                # If generated logic resets stats, we need to handle that. 
-                # StatsService usually valid until Xray restart.
-                
-                if new_up > old_up or new_down > old_down:
-                    # Activity detected
-                    c.execute("UPDATE users SET traffic_up=?, traffic_down=?, last_active=? WHERE username=?",
-                              (new_up, new_down, datetime.datetime.now(), username))
-                else:
-                    # Just update stats, not last_active
-                     c.execute("UPDATE users SET traffic_up=?, traffic_down=? WHERE username=?",
-                              (new_up, new_down, username))
-            
-            conn.commit()
-            conn.close()
-
+            return self.apply_traffic_deltas(self.collect_traffic())
         except Exception as e:
             print(f"Stats update failed: {e}")
@@ -0,0 +1,208 @@
+"""
+Minimal Prometheus metrics for the control plane (text exposition format, no client library).
+
+Timers are time.perf_counter() pairs plus one bisect into fixed buckets under a lock, cheap
+enough to leave on every call:
+
+    @OPERATIONS.timed("apply_batch")          # whole VPNManager operation
+    with PHASES.time("apply_batch", "db"):    # one phase inside it
+
+render() returns the /metrics body. SamplingProfiler is the opt-in per-request profiler used by
+api_server.py (PROFILE_REQUESTS=true): it samples the stacks of all threads, so it also covers
+sync endpoints that FastAPI runs in its thread pool.
+"""
+import bisect
+import collections
+import functools
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Seconds; covers ~0.1 ms in-memory paths up to multi-second Xray restarts
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: List["_Metric"] = []
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _fmt(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple, float] = collections.defaultdict(int)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def _samples(self):
+        with self._lock:
+            return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Set directly, or computed at scrape time by `callback` returning {label tuple: value}."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), callback: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self.callback = callback
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def _samples(self):
+        values = dict(self._values)
+        if self.callback is not None:
+            try:
+                values.update(self.callback())
+            except Exception:
+                pass  # A failing collector must not break the whole scrape
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, list] = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def timed(self, *labels):
+        """Decorator form of time()."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(*labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._series.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_fmt(series[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# --- metrics shared by the control plane ---
+
+OPERATIONS = Histogram("vless_operation_seconds", "Latency of VPNManager operations", ("op",))
+PHASES = Histogram("vless_phase_seconds", "Latency of phases inside VPNManager operations", ("op", "phase"))
+HTTP_REQUESTS = Histogram("vless_http_request_seconds", "API request latency", ("method", "route", "status"))
+XRAY_RESTARTS = Counter("vless_xray_restarts_total", "systemctl restart xray calls")
+XRAY_LIVE_UPDATES = Counter("vless_xray_live_updates_total", "Client changes pushed through the Xray gRPC API", ("result",))
+SQLITE_LOCK_WAITS = Counter("vless_sqlite_lock_waits_total",
+                            "Write transactions that had to wait (busy-retry) for the SQLite write lock")
+SQLITE_LOCK_TIMEOUTS = Counter("vless_sqlite_lock_timeouts_total", "Write transactions that gave up on the SQLite write lock")
+CONFIG_BYTES = Gauge("vless_config_bytes", "Size of config.json as last read or written")
+CONFIG_CLIENTS = Gauge("vless_config_clients", "VLESS clients in the resident config")
+# api_server.py sets the callback (VPNManager.user_counts)
+USERS = Gauge("vless_users", "Users by state (active = traffic in the last hour)", ("state",))
+ACCESS_LOG_LINES = Counter("vless_access_log_lines_total", "Xray access log lines read (accepted connections / other)", ("result",))
+# api_server.py sets the callback (access_log.ActivityTable.online_count)
+ONLINE_USERS = Gauge("vless_online_users", "Users with an accepted connection in the access log recently")
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of all other threads every `interval` seconds while running.
+    folded() returns them in the collapsed format flamegraph.pl / speedscope read:
+    "thread;outer_fn (file:line);...;inner_fn (file:line) <samples>".
+    """
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.samples: Dict[str, int] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in sorted(self.samples.items(), key=lambda kv: -kv[1]))
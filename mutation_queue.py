@@ -0,0 +1,128 @@
+"""
+Single-writer queue for user mutations in the API process.
+
+Async handlers enqueue an operation and await its result. One writer task drains the queue:
+creates/deletes that arrive close together (within COALESCE_WINDOW) are merged into a single
+VPNManager.apply_batch call, i.e. one DB transaction and one config commit. Because there is
+only one writer, concurrent requests can no longer race on config.json and lose clients.
+"""
+import asyncio
+import time
+from typing import Callable, Dict, List, Optional
+
+from manage_vless import VPNManager
+
+# Seconds the writer waits for more mutations before committing a batch
+COALESCE_WINDOW = 0.005
+# Upper bound on operations merged into one apply_batch
+MAX_BATCH = 500
+
+
+class MutationQueue:
+    def __init__(self, manager: VPNManager, window: float = COALESCE_WINDOW, max_batch: int = MAX_BATCH):
+        self.manager = manager
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- producers (called from request handlers) ---
+
+    async def _submit(self, op: tuple):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, future))
+        return await future
+
+    async def create(self, username: Optional[str] = None, persistent: bool = False) -> Dict:
+        return await self._submit(("create", {"username": username, "persistent": persistent}))
+
+    async def delete(self, username: str) -> Dict:
+        return await self._submit(("delete", username))
+
+    async def call(self, fn: Callable, *args, **kwargs):
+        """Runs any other mutating manager call in the writer, serialized with everything else."""
+        return await self._submit(("call", (fn, args, kwargs)))
+
+    # --- writer ---
+
+    async def _writer(self):
+        while True:
+            first = await self._queue.get()
+            pending = [first]
+            deadline = time.monotonic() + self.window
+            while len(pending) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            for segment in self._segments(pending):
+                await self._apply(segment)
+
+    @staticmethod
+    def _segments(pending: List) -> List[List]:
+        """
+        Splits queued ops into runs that can share one apply_batch without changing their meaning:
+        a username appears at most once per run (apply_batch runs deletes before creates), and a
+        "call" op always runs on its own.
+        """
+        segments, current, names = [], [], set()
+        for item in pending:
+            (kind, payload), _ = item
+            name = payload["username"] if kind == "create" else payload if kind == "delete" else None
+            if kind == "call" or (name is not None and name in names):
+                if current:
+                    segments.append(current)
+                current, names = [], set()
+                if kind == "call":
+                    segments.append([item])
+                    continue
+            current.append(item)
+            if name is not None:
+                names.add(name)
+        if current:
+            segments.append(current)
+        return segments
+
+    async def _apply(self, segment: List):
+        kind, payload = segment[0][0]
+        try:
+            if kind == "call":
+                fn, args, kwargs = payload
+                results = [await asyncio.to_thread(fn, *args, **kwargs)]
+            else:
+                creates = [payload for (kind, payload), _ in segment if kind == "create"]
+                deletes = [payload for (kind, payload), _ in segment if kind == "delete"]
+                res = await asyncio.to_thread(self.manager.apply_batch, creates, deletes)
+                created = iter(res["created"])
+                deleted = {d["username"]: d for d in res["deleted"]}
+                results = []
+                for (kind, payload), _ in segment:
+                    if kind == "create":
+                        results.append(next(created))
+                    else:
+                        # Same shape as VPNManager.delete_user
+                        results.append(deleted.get(payload, {"error": "User not found"}))
+        except Exception as e:
+            for _, future in segment:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(segment, results):
+            if not future.done():  # The request may have been cancelled meanwhile
+                future.set_result(result)
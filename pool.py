@@ -0,0 +1,55 @@
+"""
+Warm pool of pre-created transient users, so POST /user does not wait for an Xray update.
+
+Pool users are normal rows with is_pooled = 1 whose clients are already in config.json / the
+running Xray. A create without a username claims one of them in the DB (VPNManager.apply_batch),
+which touches neither the config nor Xray. When the pool drops to USER_POOL_LOW_WATER it is
+topped back up to USER_POOL_SIZE with a single apply_batch (one config commit for the whole batch).
+
+Pool users are hidden from /users, /users/links and the user counts in /stats, and the reaper
+never deletes them while unassigned. Requests for a specific username bypass the pool.
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from manage_vless import VPNManager
+
+log = logging.getLogger("vless.pool")
+
+
+class UserPool:
+    def __init__(self, manager: VPNManager, size: int = 0, low_water: int = 0):
+        self.manager = manager
+        self.size = size
+        self.low_water = min(low_water, size)
+        self._refill_task: Optional[asyncio.Task] = None
+
+    def needs_refill(self) -> bool:
+        return self.size > 0 and self.manager.pool_count() <= self.low_water
+
+    def refill(self) -> int:
+        """Tops the pool up to `size`. Returns the number of users added."""
+        missing = self.size - self.manager.pool_count()
+        if missing <= 0:
+            return 0
+        res = self.manager.apply_batch(creates=[{"pooled": True}] * missing)
+        added = sum(1 for c in res["created"] if "error" not in c)
+        log.info(f"Pool refilled with {added} users")
+        return added
+
+    def kick(self, mutations) -> None:
+        """
+        Starts a background refill through the API's MutationQueue when the pool is low.
+        Called after each claim; does nothing while a refill is already running.
+        """
+        if self._refill_task is not None and not self._refill_task.done():
+            return
+        if not self.needs_refill():
+            return
+        self._refill_task = asyncio.create_task(mutations.call(self.refill))
+
+
+def pool_from_settings(manager: VPNManager) -> UserPool:
+    """Builds the pool from the manager's settings (USER_POOL_SIZE / USER_POOL_LOW_WATER; size 0 = no pool)."""
+    return UserPool(manager, size=manager.settings.user_pool_size, low_water=manager.settings.pool_low_water)
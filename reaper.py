@@ -0,0 +1,176 @@
+"""
+Long-running stats sampler + idle-user reaper (replaces the 10-minute auto_delete.py cron).
+
+Every STATS_INTERVAL_SECONDS it pulls traffic deltas from Xray, keeps each transient user's
+last activity in memory, and deletes users whose idle deadline has passed. Deadlines live in a
+min-heap, so a tick only looks at users that are actually due instead of scanning every user.
+
+Runs inside the API process by default (REAPER_IN_API=true) and deletes through its MutationQueue.
+Standalone (REAPER_IN_API=false, systemd unit vless-reaper.service):  python3 reaper.py
+It then deletes through the API's POST /users/batch (API_URL): only the API process writes
+config.json, a second VPNManager with its own resident config would overwrite the API's changes.
+Another instance: VLESS_ENV_FILE=/path/to/instance.env python3 reaper.py
+"""
+import asyncio
+import heapq
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+from fleet import RemoteAgentBackend
+from manage_vless import VPNManager
+from settings import Settings
+
+log = logging.getLogger("vless.reaper")
+
+# Every this many seconds: full re-read of transient users (to pick up changes made by other
+# processes) and server_stats / traffic series retention
+RESYNC_INTERVAL = 600
+
+
+class IdleReaper:
+    def __init__(self, manager: VPNManager, idle_timeout: int = 3 * 3600, interval: float = 30,
+                 retention_days: int = 30, delete: Optional[Callable[[List[str]], Dict]] = None):
+        self.manager = manager
+        # Deletes a batch of users (same result as VPNManager.apply_batch); see reaper_from_settings
+        self.delete = delete or (lambda usernames: manager.apply_batch(deletes=usernames))
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.retention_days = retention_days
+        self.last_active: Dict[str, int] = {}  # Transient users only
+        self._heap: List = []  # (expiry, username); entries go stale when last_active moves, skipped on pop
+        self._max_id = 0
+        self._last_resync = 0.0
+
+    def _track(self, username: str, last_active: int):
+        self.last_active[username] = last_active
+        heapq.heappush(self._heap, (last_active + self.idle_timeout, username))
+
+    def resync(self):
+        """Reloads all transient users (uses the is_persistent index)."""
+        self.last_active.clear()
+        self._heap = []
+        now = int(time.time())
+        for user_id, username, last_active in self.manager._db().execute(
+                "SELECT id, username, last_active FROM users WHERE is_persistent = 0"):
+            self._track(username, last_active if last_active is not None else now)
+            self._max_id = max(self._max_id, user_id)
+        self._last_resync = time.monotonic()
+
+    def _load_new_users(self):
+        """Picks up users created since the last tick (primary-key range scan)."""
+        now = int(time.time())
+        for user_id, username, last_active, is_persistent in self.manager._db().execute(
+                "SELECT id, username, last_active, is_persistent FROM users WHERE id > ?", (self._max_id,)):
+            self._max_id = max(self._max_id, user_id)
+            if not is_persistent:
+                self._track(username, last_active if last_active is not None else now)
+
+    def _pop_due(self, now: int) -> List[str]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            expiry, username = heapq.heappop(self._heap)
+            last_active = self.last_active.get(username)
+            if last_active is None or last_active + self.idle_timeout != expiry:
+                continue  # Stale entry (user deleted or active since)
+            due.append(username)
+        return due
+
+    def tick(self) -> List[str]:
+        """One sampling + reaping pass. Returns the deleted usernames."""
+        if time.monotonic() - self._last_resync >= RESYNC_INTERVAL:
+            self.resync()
+            self.manager.prune_server_stats(self.retention_days)
+            self.manager.prune_traffic()
+        else:
+            self._load_new_users()
+
+        # 1. Traffic deltas -> DB and in-memory activity
+        try:
+            deltas = self.manager.collect_traffic()
+            self.manager.apply_traffic_deltas(deltas)
+        except Exception as e:
+            log.warning(f"Stats update failed: {e}")
+            deltas = {}
+        now = int(time.time())
+        for username, (up, down) in deltas.items():
+            if (up or down) and username in self.last_active:
+                self._track(username, now)
+
+        # 2. Reap users whose deadline passed
+        due = self._pop_due(now)
+        if not due:
+            return []
+        # Another process (API, log tailer) may have seen activity or deleted them: re-check the DB
+        placeholders = ",".join("?" * len(due))
+        rows = self.manager._db().execute(
+            f"SELECT username, last_active, is_persistent, is_pooled FROM users WHERE username IN ({placeholders})", due).fetchall()
+        for username in due:
+            self.last_active.pop(username, None)
+        to_delete, deadlines = [], {}
+        for username, last_active, is_persistent, is_pooled in rows:
+            if is_persistent:
+                continue
+            if is_pooled:
+                # Unassigned pool users never idle out; once claimed, last_active is the claim time
+                self._track(username, now)
+                continue
+            if last_active is not None and last_active + self.idle_timeout > now:
+                self._track(username, last_active)  # Active elsewhere: new deadline
+                continue
+            to_delete.append(username)
+            deadlines[username] = last_active if last_active is not None else now - self.idle_timeout
+
+        if to_delete:
+            try:
+                self.delete(to_delete)
+            except Exception:
+                # Still due: retried next tick
+                for username in to_delete:
+                    self._track(username, deadlines[username])
+                raise
+            log.info(f"Deleted {len(to_delete)} idle users: {', '.join(to_delete)}")
+        return to_delete
+
+    async def run(self):
+        """Runs tick() every `interval` seconds until cancelled. Blocking work happens in a worker thread."""
+        log.info(f"Reaper started (interval {self.interval}s, idle timeout {self.idle_timeout}s)")
+        while True:
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(self.tick)
+            except Exception as e:
+                log.exception(f"Reaper tick failed: {e}")
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+def api_delete_from_settings(settings: Settings) -> Callable[[List[str]], Dict]:
+    """
+    Deletes through the running API (POST /users/batch at API_URL) with the first key in api_key.txt,
+    read on every call so a token update is picked up.
+    """
+    def delete(usernames: List[str]) -> Dict:
+        with open(settings.api_key_file) as f:
+            parts = f.readline().split()
+        if not parts:
+            raise RuntimeError(f"No API key in {settings.api_key_file}")
+        return RemoteAgentBackend("api", settings.api_url, parts[0]).apply_batch([], usernames)
+    return delete
+
+
+def reaper_from_settings(manager: VPNManager, delete: Optional[Callable[[List[str]], Dict]] = None) -> IdleReaper:
+    """
+    Builds a reaper from the manager's settings (IDLE_TIMEOUT_HOURS / STATS_INTERVAL_SECONDS / STATS_RETENTION_DAYS).
+    `delete` must go through whatever process owns config.json (see the module docstring).
+    """
+    settings = manager.settings
+    return IdleReaper(manager, idle_timeout=int(settings.idle_timeout_hours * 3600),
+                      interval=settings.stats_interval_seconds, retention_days=settings.stats_retention_days,
+                      delete=delete)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    settings = Settings.from_env()
+    # Traffic sampling only touches the DB; deletions go through the API, which owns config.json
+    asyncio.run(reaper_from_settings(VPNManager(settings), delete=api_delete_from_settings(settings)).run())
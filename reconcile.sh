@@ -0,0 +1,32 @@
+#!/bin/bash
+# reconcile.sh - Brings config.json / Xray and whitelist.txt in line with the user database
+# Usage: ./reconcile.sh [-n]    (-n: dry run, only show the differences)
+
+# Load .env if exists
+if [ -f "/opt/vless/.env" ]; then
+    export $(grep -v '^#' "/opt/vless/.env" | xargs)
+fi
+
+API_PORT=${API_PORT:-8000}
+API_URL="http://127.0.0.1:$API_PORT"
+API_KEY_FILE="/opt/vless/api_key.txt"
+
+if [ ! -f "$API_KEY_FILE" ]; then
+    echo "Error: API Key not found. Is the system installed?"
+    exit 1
+fi
+
+# First key in the file (lines are "<key> [<name> [<requests_per_minute>]]")
+API_KEY=$(awk 'NR==1{print $1}' "$API_KEY_FILE")
+
+DRY_RUN=false
+if [[ "$1" == "-n" ]]; then
+    DRY_RUN=true
+    echo "Dry run: nothing will be changed."
+fi
+
+RESPONSE=$(curl -s -X POST "$API_URL/users/reconcile?dry_run=$DRY_RUN" \
+     -H "X-API-KEY: $API_KEY")
+
+echo "Response:"
+echo "$RESPONSE" | python3 -m json.tool 2>/dev/null || echo "$RESPONSE"
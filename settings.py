@@ -0,0 +1,113 @@
+"""
+Settings for one control-plane instance, loaded once from .env / the environment.
+
+Everything that used to be a hard-coded path or an os.getenv() call scattered over the modules
+lives here, so several isolated instances (own DB, config.json, Xray service and link files) can
+run side by side: point each process at its own env file with VLESS_ENV_FILE, or build
+Settings(...) directly and pass it to VPNManager / api_server.create_app.
+
+Defaults match the single-instance layout vless.sh installs.
+"""
+import os
+from dataclasses import dataclass, fields
+from typing import Dict, Optional
+
+DEFAULT_ENV_FILE = "/opt/vless/.env"
+
+
+def _int(value: str, default: int) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def _float(value: str, default: float) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+def _bool(value: str, default: bool) -> bool:
+    return value.strip().lower() == "true" if value.strip() else default
+
+
+@dataclass(frozen=True)
+class Settings:
+    # Paths and binaries
+    xray_config_path: str = "/usr/local/etc/xray/config.json"
+    db_path: str = "/opt/vless/vless.db"
+    whitelist_path: str = "/opt/vless/whitelist.txt"
+    vless_dir: str = "/opt/vless"  # server_ip.txt, reality_*.txt, ... (see links.py)
+    api_key_file: str = "/opt/vless/api_key.txt"
+    profile_dir: str = "/opt/vless/profiles"
+    xray_bin: str = "/usr/local/bin/xray"
+    # The Xray this instance manages
+    xray_api_addr: str = "127.0.0.1:10085"
+    xray_service: str = "xray"  # systemd unit restarted after config writes
+    # VLESS inbounds new users are spread over (comma-separated tags; empty = every tagged VLESS inbound)
+    inbound_tags: str = ""
+    inbound_policy: str = "least_clients"  # or least_traffic (see manage_vless.INBOUND_POLICIES)
+    # Access log tailer (see access_log.py); empty = off
+    xray_access_log: str = "/var/log/xray/access.log"
+    access_log_offset_file: str = "/opt/vless/access_log.offset"
+    # Idle reaper / stats
+    idle_timeout_hours: float = 3.0
+    stats_interval_seconds: float = 30.0
+    stats_retention_days: int = 30
+    reaper_in_api: bool = True
+    # This instance's API, for processes that change users through it (standalone reaper.py, auto_delete.py)
+    api_url: str = "http://127.0.0.1:8000"
+    # Warm pool
+    user_pool_size: int = 0
+    user_pool_low_water: Optional[int] = None  # Default: a quarter of the pool
+    # Fleet mode
+    fleet_nodes: str = ""
+    fleet_api_key: str = ""
+    fleet_scheduler: str = "least_loaded"
+    # Observability
+    metrics_public: bool = False
+    profile_requests: bool = False
+
+    @classmethod
+    def from_env(cls, env_file: Optional[str] = None, environ: Optional[Dict[str, str]] = None) -> "Settings":
+        """
+        Reads every field from the upper-cased variable of the same name (DB_PATH, XRAY_SERVICE, ...).
+        The env file (VLESS_ENV_FILE, default /opt/vless/.env) fills in variables the environment
+        does not set; unparsable values fall back to the default.
+        """
+        if environ is None:
+            environ = dict(os.environ)
+            env_file = env_file or environ.get("VLESS_ENV_FILE", DEFAULT_ENV_FILE)
+            if env_file and os.path.exists(env_file):
+                try:
+                    from dotenv import dotenv_values
+                except ImportError:
+                    dotenv_values = None
+                if dotenv_values is not None:
+                    for key, value in dotenv_values(env_file).items():
+                        if value is not None:
+                            environ.setdefault(key, value)
+
+        values = {}
+        for f in fields(cls):
+            raw = environ.get(f.name.upper())
+            if raw is None:
+                continue
+            default = f.default
+            if isinstance(default, bool):
+                values[f.name] = _bool(raw, default)
+            elif isinstance(default, int) or f.name == "user_pool_low_water":
+                if raw.strip():
+                    values[f.name] = _int(raw, default)
+            elif isinstance(default, float):
+                values[f.name] = _float(raw, default)
+            else:
+                values[f.name] = raw.strip()
+        return cls(**values)
+
+    @property
+    def pool_low_water(self) -> int:
+        low = self.user_pool_size // 4 if self.user_pool_low_water is None else self.user_pool_low_water
+        return min(low, self.user_pool_size)
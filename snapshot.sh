@@ -0,0 +1,47 @@
+#!/bin/bash
+# snapshot.sh - Exports or imports all users (UUIDs, persistence, traffic) to bootstrap another server
+# Usage: ./snapshot.sh export users.json
+#        ./snapshot.sh import users.json [--replace]   (--replace: delete users not in the file)
+
+# Load .env if exists
+if [ -f "/opt/vless/.env" ]; then
+    export $(grep -v '^#' "/opt/vless/.env" | xargs)
+fi
+
+API_PORT=${API_PORT:-8000}
+API_URL="http://127.0.0.1:$API_PORT"
+API_KEY_FILE="/opt/vless/api_key.txt"
+
+if [ ! -f "$API_KEY_FILE" ]; then
+    echo "Error: API Key not found. Is the system installed?"
+    exit 1
+fi
+
+# First key in the file (lines are "<key> [<name> [<requests_per_minute>]]")
+API_KEY=$(awk 'NR==1{print $1}' "$API_KEY_FILE")
+
+ACTION=$1
+FILE=$2
+if [ -z "$FILE" ] || { [ "$ACTION" != "export" ] && [ "$ACTION" != "import" ]; }; then
+    echo "Usage: $0 export|import <file> [--replace]"
+    exit 1
+fi
+
+if [ "$ACTION" == "export" ]; then
+    curl -s -f -o "$FILE" "$API_URL/users/snapshot" -H "X-API-KEY: $API_KEY" || { echo "Export failed"; exit 1; }
+    echo "Snapshot written to $FILE"
+    exit 0
+fi
+
+REPLACE=false
+if [[ "$3" == "--replace" ]]; then
+    REPLACE=true
+fi
+
+RESPONSE=$(curl -s -X POST "$API_URL/users/snapshot?replace=$REPLACE" \
+     -H "X-API-KEY: $API_KEY" \
+     -H "Content-Type: application/json" \
+     --data-binary @"$FILE")
+
+echo "Response:"
+echo "$RESPONSE" | python3 -m json.tool 2>/dev/null || echo "$RESPONSE"
@@ -2,6 +2,8 @@
 
 # update_token.sh - Update API Token
 # Usage: ./update_token.sh [new_token]
+# Replaces the first key in api_key.txt (the one vless.sh generated); its name / rate limit and
+# any other keys are kept.
 
 INSTALL_DIR="/opt/vless"
 API_KEY_FILE="$INSTALL_DIR/api_key.txt"
@@ -15,7 +17,11 @@ else
 fi
 
 echo "Updating API Token..."
-echo "$NEW_TOKEN" > "$API_KEY_FILE"
+if [ -s "$API_KEY_FILE" ]; then
+    awk -v key="$NEW_TOKEN" 'NR==1{$1=key} {print}' "$API_KEY_FILE" > "$API_KEY_FILE.tmp" && mv "$API_KEY_FILE.tmp" "$API_KEY_FILE"
+else
+    echo "$NEW_TOKEN" > "$API_KEY_FILE"
+fi
 echo "New Token: $NEW_TOKEN"
 
 # Also update .env if it exists to persist across re-runs
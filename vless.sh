@@ -41,7 +41,7 @@ echo "Setting up Python environment..."
 if [ ! -d "$INSTALL_DIR/venv" ]; then
     python3 -m venv "$INSTALL_DIR/venv"
 fi
-"$INSTALL_DIR/venv/bin/pip" install fastapi uvicorn pydantic requests
+"$INSTALL_DIR/venv/bin/pip" install fastapi uvicorn pydantic requests grpcio python-dotenv
 
 # 5. Config Generation Logic
 mkdir -p "$INSTALL_DIR/ssl_cert"
@@ -121,11 +121,12 @@ if [ "$MODE" == "reality" ]; then
     # Generate Base Config with jq using REALITY
     jq -n --arg port "$VPN_PORT" --arg pk "$PK" --arg sid "$SID" \
     '{
-        log: {loglevel: "warning"},
+        log: {loglevel: "warning", access: "/var/log/xray/access.log"},
         inbounds: [
             {
                 port: ($port|tonumber),
                 protocol: "vless",
+                tag: "vless-in",
                 settings: {clients: [], decryption: "none"},
                 streamSettings: {
                     network: "tcp",
@@ -154,7 +155,7 @@ if [ "$MODE" == "reality" ]; then
             {protocol: "blackhole", tag: "blocked"}
         ],
         stats: {},
-        api: {tag: "api", services: ["StatsService"]},
+        api: {tag: "api", services: ["HandlerService", "StatsService"]},
         policy: {
             levels: {"0": {statsUserUplink: true, statsUserDownlink: true}},
             system: {statsInboundUplink: true, statsInboundDownlink: true}
@@ -167,11 +168,12 @@ elif [ "$MODE" == "tls" ]; then
     # Generate Base Config with jq using TLS
     jq -n --arg port "$VPN_PORT" --arg cert "$CERT_FULLCHAIN" --arg key "$CERT_KEY" \
     '{
-        log: {loglevel: "warning"},
+        log: {loglevel: "warning", access: "/var/log/xray/access.log"},
         inbounds: [
             {
                 port: ($port|tonumber),
                 protocol: "vless",
+                tag: "vless-in",
                 settings: {clients: [], decryption: "none"},
                 streamSettings: {
                     network: "tcp",
@@ -195,7 +197,7 @@ elif [ "$MODE" == "tls" ]; then
             {protocol: "blackhole", tag: "blocked"}
         ],
         stats: {},
-        api: {tag: "api", services: ["StatsService"]},
+        api: {tag: "api", services: ["HandlerService", "StatsService"]},
         policy: {
             levels: {"0": {statsUserUplink: true, statsUserDownlink: true}},
             system: {statsInboundUplink: true, statsInboundDownlink: true}
@@ -203,6 +205,21 @@ elif [ "$MODE" == "tls" ]; then
     }' > "$XRAY_CONFIG"
 fi
 
+# Access log (read by the API for online users / last activity, see access_log.py).
+# The Xray installer creates /var/log/xray for the user Xray runs as. copytruncate: Xray keeps
+# its file handle, so the log must be truncated in place, not renamed.
+cat <<EOF > /etc/logrotate.d/xray-access
+/var/log/xray/access.log {
+    daily
+    rotate 2
+    missingok
+    notifempty
+    compress
+    delaycompress
+    copytruncate
+}
+EOF
+
 # 7. Generate API Key if missing
 if [ ! -f "$API_KEY_FILE" ]; then
     openssl rand -hex 16 > "$API_KEY_FILE"
@@ -212,12 +229,24 @@ fi
 echo "Copying scripts to $INSTALL_DIR..."
 # Assuming scripts are in current directory
 [ -f manage_vless.py ] && cp manage_vless.py "$INSTALL_DIR/"
+[ -f settings.py ] && cp settings.py "$INSTALL_DIR/"
+[ -f xray_api.py ] && cp xray_api.py "$INSTALL_DIR/"
+[ -f links.py ] && cp links.py "$INSTALL_DIR/"
 [ -f api_server.py ] && cp api_server.py "$INSTALL_DIR/"
 [ -f auto_delete.py ] && cp auto_delete.py "$INSTALL_DIR/"
+[ -f reaper.py ] && cp reaper.py "$INSTALL_DIR/"
+[ -f mutation_queue.py ] && cp mutation_queue.py "$INSTALL_DIR/"
+[ -f auth.py ] && cp auth.py "$INSTALL_DIR/"
+[ -f fleet.py ] && cp fleet.py "$INSTALL_DIR/"
+[ -f pool.py ] && cp pool.py "$INSTALL_DIR/"
+[ -f metrics.py ] && cp metrics.py "$INSTALL_DIR/"
+[ -f access_log.py ] && cp access_log.py "$INSTALL_DIR/"
 [ -f update_token.sh ] && cp update_token.sh "$INSTALL_DIR/"
 [ -f create_user.sh ] && cp create_user.sh "$INSTALL_DIR/"
 [ -f delete_user.sh ] && cp delete_user.sh "$INSTALL_DIR/"
 [ -f delete_all_users.sh ] && cp delete_all_users.sh "$INSTALL_DIR/"
+[ -f reconcile.sh ] && cp reconcile.sh "$INSTALL_DIR/"
+[ -f snapshot.sh ] && cp snapshot.sh "$INSTALL_DIR/"
 
 [ -f vless.db ] || touch "$INSTALL_DIR/vless.db" # Create DB if not exists
 chown -R root:root "$INSTALL_DIR"
@@ -226,6 +255,8 @@ chmod +x "$INSTALL_DIR/update_token.sh"
 chmod +x "$INSTALL_DIR/create_user.sh"
 chmod +x "$INSTALL_DIR/delete_user.sh"
 chmod +x "$INSTALL_DIR/delete_all_users.sh"
+chmod +x "$INSTALL_DIR/reconcile.sh"
+chmod +x "$INSTALL_DIR/snapshot.sh"
 
 
 # 9. Create Systemd Service for API
@@ -245,11 +276,36 @@ Restart=always
 WantedBy=multi-user.target
 EOF
 
+# Stats sampler / idle reaper (replaces the old auto_delete.py cron job). Runs inside the API by default;
+# REAPER_IN_API=false runs it as its own service, which deletes users through the API
+echo "Creating Reaper Service..."
+cat <<EOF > /etc/systemd/system/vless-reaper.service
+[Unit]
+Description=VLESS VPN Stats Sampler and Idle Reaper
+After=network.target xray.service
+
+[Service]
+User=root
+WorkingDirectory=$INSTALL_DIR
+Environment=API_URL=http://127.0.0.1:$API_PORT
+ExecStart=$INSTALL_DIR/venv/bin/python3 reaper.py
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
 # 10. Start Services
 echo "Starting Services..."
 systemctl daemon-reload
 systemctl enable xray vless-api
 systemctl restart xray vless-api
+if [ "${REAPER_IN_API:-true}" == "true" ]; then
+    systemctl disable --now vless-reaper 2>/dev/null
+else
+    systemctl enable vless-reaper
+    systemctl restart vless-reaper
+fi
 
 echo "Verifying..."
 sleep 2
@@ -271,12 +327,12 @@ else
     systemctl status xray
 fi
 
-# Cron Job
-(crontab -l 2>/dev/null; echo "*/10 * * * * cd $INSTALL_DIR && $INSTALL_DIR/venv/bin/python3 auto_delete.py >> /var/log/vless_autodel.log 2>&1") | crontab -
+# Cron Job (legacy): idle cleanup now runs continuously in vless-reaper, drop the old 10-minute job
+(crontab -l 2>/dev/null | grep -v "auto_delete.py") | crontab -
 
 echo 
 echo "-----------------------------------------------------"
 echo -e "${GREEN}Installation Complete!${NC}"
 echo "API Key loaded in: $API_KEY_FILE"
-echo "API Key: $(cat $API_KEY_FILE)"
+echo "API Key: $(awk 'NR==1{print $1}' "$API_KEY_FILE")"
 echo "-----------------------------------------------------"
\ No newline at end of file
@@ -0,0 +1,205 @@
+"""
+Minimal in-process client for the Xray gRPC API (the `api` dokodemo-door on 127.0.0.1:10085).
+
+Instead of shipping generated protobuf stubs we hand-encode the handful of messages we need
+and send them as raw bytes through grpcio's generic unary call. grpcio is optional: if it is
+not installed, `available()` returns False and callers fall back to the config.json + restart path.
+"""
+import threading
+from typing import Dict, List
+
+try:
+    import grpc
+except ImportError:  # pragma: no cover - depends on the venv
+    grpc = None
+
+XRAY_API_ADDR = "127.0.0.1:10085"
+
+# Fully-qualified gRPC method / protobuf type names (see Xray-core app/proxyman/command/command.proto)
+HANDLER_ALTER_INBOUND = "/xray.app.proxyman.command.HandlerService/AlterInbound"
+STATS_QUERY = "/xray.app.stats.command.StatsService/QueryStats"
+TYPE_ADD_USER = "xray.app.proxyman.command.AddUserOperation"
+TYPE_REMOVE_USER = "xray.app.proxyman.command.RemoveUserOperation"
+TYPE_VLESS_ACCOUNT = "xray.proxy.vless.Account"
+
+
+class XrayAPIError(Exception):
+    pass
+
+
+# --- protobuf wire encoding (only what we need: varints + length-delimited fields) ---
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def _field_bytes(num: int, data: bytes) -> bytes:
+    if not data:
+        return b""  # proto3 default, omitted on the wire
+    return _varint((num << 3) | 2) + _varint(len(data)) + data
+
+
+def _field_str(num: int, value: str) -> bytes:
+    return _field_bytes(num, value.encode("utf-8"))
+
+
+def _field_varint(num: int, value: int) -> bytes:
+    if not value:
+        return b""
+    return _varint(num << 3) + _varint(value)
+
+
+def iter_fields(buf: bytes):
+    """Yields (field_number, wire_type, value) from a protobuf message. value is int or bytes."""
+    pos, end = 0, len(buf)
+
+    def read_varint():
+        nonlocal pos
+        shift = result = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7F) << shift
+            if not b & 0x80:
+                return result
+            shift += 7
+
+    while pos < end:
+        key = read_varint()
+        num, wire = key >> 3, key & 7
+        if wire == 0:
+            yield num, wire, read_varint()
+        elif wire == 2:
+            n = read_varint()
+            yield num, wire, buf[pos:pos + n]
+            pos += n
+        elif wire == 1:
+            yield num, wire, buf[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            yield num, wire, buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise XrayAPIError(f"Unsupported protobuf wire type {wire}")
+
+
+def _typed_message(type_name: str, value: bytes) -> bytes:
+    # xray.common.serial.TypedMessage { string type = 1; bytes value = 2; }
+    return _field_str(1, type_name) + _field_bytes(2, value)
+
+
+def encode_add_user(tag: str, email: str, user_uuid: str, flow: str = "", level: int = 0) -> bytes:
+    # xray.proxy.vless.Account { string id = 1; string flow = 2; }
+    account = _field_str(1, user_uuid) + _field_str(2, flow)
+    # xray.common.protocol.User { uint32 level = 1; string email = 2; TypedMessage account = 3; }
+    user = _field_varint(1, level) + _field_str(2, email) + _field_bytes(3, _typed_message(TYPE_VLESS_ACCOUNT, account))
+    # AddUserOperation { User user = 1; }
+    op = _field_bytes(1, user)
+    # AlterInboundRequest { string tag = 1; TypedMessage operation = 2; }
+    return _field_str(1, tag) + _field_bytes(2, _typed_message(TYPE_ADD_USER, op))
+
+
+def encode_remove_user(tag: str, email: str) -> bytes:
+    # RemoveUserOperation { string email = 1; }
+    op = _field_str(1, email)
+    return _field_str(1, tag) + _field_bytes(2, _typed_message(TYPE_REMOVE_USER, op))
+
+
+def encode_query_stats(pattern: str, reset: bool = False) -> bytes:
+    # QueryStatsRequest { string pattern = 1; bool reset = 2; }
+    return _field_str(1, pattern) + _field_varint(2, 1 if reset else 0)
+
+
+def decode_query_stats(buf: bytes) -> Dict[str, int]:
+    # QueryStatsResponse { repeated Stat stat = 1; }  Stat { string name = 1; int64 value = 2; }
+    stats = {}
+    for num, _, stat in iter_fields(buf):
+        if num != 1:
+            continue
+        name, value = "", 0
+        for f, _, v in iter_fields(stat):
+            if f == 1:
+                name = v.decode("utf-8")
+            elif f == 2:
+                value = v - (1 << 64) if v >= (1 << 63) else v  # int64 two's complement
+        stats[name] = value
+    return stats
+
+
+def user_traffic(stats: Dict[str, int]) -> Dict[str, List[int]]:
+    """Turns `user>>>{email}>>>traffic>>>{uplink|downlink}` counters into {email: [up, down]}."""
+    traffic = {}
+    for name, value in stats.items():
+        parts = name.split(">>>")
+        if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic":
+            continue
+        entry = traffic.setdefault(parts[1], [0, 0])
+        if parts[3] == "uplink":
+            entry[0] += value
+        elif parts[3] == "downlink":
+            entry[1] += value
+    return traffic
+
+
+class XrayAPI:
+    """Thin wrapper around a lazily-opened gRPC channel to the running Xray."""
+
+    def __init__(self, addr: str = XRAY_API_ADDR, timeout: float = 3.0):
+        self.addr = addr
+        self.timeout = timeout
+        self._channel = None
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return grpc is not None
+
+    def _get_channel(self):
+        if self._channel is None:
+            with self._lock:
+                if self._channel is None:
+                    self._channel = grpc.insecure_channel(self.addr)
+        return self._channel
+
+    def _call(self, method: str, payload: bytes) -> bytes:
+        if not self.available():
+            raise XrayAPIError("grpcio is not installed")
+        # No serializers given -> grpcio sends/returns raw bytes
+        fn = self._get_channel().unary_unary(method)
+        try:
+            return fn(payload, timeout=self.timeout)
+        except grpc.RpcError as e:
+            raise XrayAPIError(f"{method}: {e.code()} {e.details()}") from e
+
+    def add_user(self, tag: str, email: str, user_uuid: str, flow: str = ""):
+        try:
+            self._call(HANDLER_ALTER_INBOUND, encode_add_user(tag, email, user_uuid, flow))
+        except XrayAPIError as e:
+            # Idempotent: already present on the running inbound is fine
+            if "already exists" not in str(e).lower():
+                raise
+
+    def remove_user(self, tag: str, email: str):
+        try:
+            self._call(HANDLER_ALTER_INBOUND, encode_remove_user(tag, email))
+        except XrayAPIError as e:
+            if "not found" not in str(e).lower():
+                raise
+
+    def query_stats(self, pattern: str = "", reset: bool = False) -> Dict[str, int]:
+        """All counters whose name contains `pattern`, in one call. reset=True zeroes them server-side,
+        so consecutive calls return deltas that survive Xray restarts."""
+        return decode_query_stats(self._call(STATS_QUERY, encode_query_stats(pattern, reset)))
+
+    def close(self):
+        with self._lock:
+            if self._channel is not None:
+                self._channel.close()
+                self._channel = None